@@ -0,0 +1,98 @@
+"""
+Compares `make_chunks` (full en_core_web_sm pipeline, repeated string concatenation)
+with `make_chunks_fast` (sentence segmentation only, nlp.pipe, linear joins).
+
+Run from the repository root:
+    python -m benchmarks.chunking --chars 300000 --docs 4
+    python -m benchmarks.chunking data/legal_docs/<case>/<file>.pdf
+"""
+
+import argparse
+import random
+import time
+
+import spacy
+
+from src.settlement_website_analysis.page_text import BODY_CLIP, get_pages
+from src.settlement_website_analysis.summary_extractions import (
+    load_chunker,
+    make_chunks,
+    make_chunks_fast,
+)
+
+SENTENCES = [
+    "The Settlement Class consists of all persons who purchased common stock during the Class Period.",
+    "Lead Counsel will apply for an award of attorneys' fees not to exceed 25% of the Settlement Fund.",
+    "Pursuant to Rule 23(e) of the Federal Rules of Civil Procedure, the Court held a hearing.",
+    "Defendants deny any wrongdoing, fault, liability or damage whatsoever.",
+    "The Net Settlement Fund will be distributed to Authorized Claimants on a pro rata basis.",
+]
+
+
+def synthetic_text(chars: int, seed: int = 0) -> str:
+    """Legal-sounding prose with occasional long unpunctuated runs, like table dumps."""
+    rng = random.Random(seed)
+    parts, length = [], 0
+    while length < chars:
+        if rng.random() < 0.05:
+            part = " ".join(f"${rng.randint(1, 10**6):,}" for _ in range(300)) + " "
+        else:
+            part = rng.choice(SENTENCES) + " "
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def timed(func, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "pdfs", nargs="*", help="PDFs to chunk instead of synthetic text"
+    )
+    parser.add_argument("--chars", type=int, default=200_000)
+    parser.add_argument("--docs", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--maxlen", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.pdfs:
+        texts = [
+            "".join(r"\n" + page for page in get_pages(pdf, BODY_CLIP))
+            for pdf in args.pdfs
+        ]
+    else:
+        texts = [synthetic_text(args.chars, seed) for seed in range(args.docs)]
+    print(f"{len(texts)} texts, {sum(map(len, texts)):,} characters")
+
+    full = spacy.load("en_core_web_sm")
+    full.max_length = fast_max = max(map(len, texts)) + 1
+    slow_time, slow = timed(
+        lambda: [make_chunks(t, nlp=full, maxlen=args.maxlen) for t in texts],
+        args.repeat,
+    )
+    print(f"make_chunks:                     {slow_time:8.2f}s")
+
+    for rule_based in (False, True):
+        nlp = load_chunker(rule_based=rule_based)
+        nlp.max_length = fast_max
+        fast_time, fast = timed(
+            lambda: make_chunks_fast(texts, nlp=nlp, maxlen=args.maxlen), args.repeat
+        )
+        label = "sentencizer" if rule_based else "parser only"
+        status = "identical" if fast == slow else "differs"
+        print(
+            f"make_chunks_fast ({label}): {fast_time:8.2f}s "
+            f"x{slow_time / fast_time:.1f}, output {status}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+Local OpenAI-compatible stand-in for load-testing the pipelines without network access.
+
+Serves /v1/chat/completions and /v1/embeddings with deterministic answers: the same
+request always gets the same completion or vector. Structured-output calls (forced tool
+calls or a json_schema response format) are answered with values generated from the
+schema, so `SettlementHomePage`, `LegalTeam`, `ADPS`, `AttorneyFees`, `ExpenseTable`,
+`PageTitles` and `DocumentSummary` all parse. Latency, server errors, 429s and a
+requests-per-minute cap are configurable, and GET /stats reports what was served.
+
+Run from the repository root:
+    python -m benchmarks.fake_openai --port 8799 --latency 0.5 --error-rate 0.01 --rate-limit-rate 0.05
+
+then run a pipeline against it from a scratch copy of the repository, as its fake answers
+would otherwise be saved to data/data.db and the LLM cache:
+    cp -r data src /tmp/load && cd /tmp/load
+    openai_base_url=http://127.0.0.1:8799/v1 openai_api=fake python -m src.settlement_website_analysis.notice_extraction
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+words = (
+    "settlement class plaintiffs defendants court notice motion expenses fees "
+    "shares distribution allocation claim period securities counsel approval"
+).split()
+
+
+class FakeConfig(NamedTuple):
+    # seconds per chat completion, varied by up to +-jitter of itself
+    latency: float = 0.2
+    embedding_latency: float = 0.05
+    jitter: float = 0.5
+    # share of requests answered 500, and 429 with a Retry-After of `retry_after`
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    # requests beyond this many in the last minute are answered 429 (None for no cap)
+    requests_per_minute: int = None
+    # share of nullable fields left null in structured outputs
+    null_rate: float = 0.0
+    dimensions: int = 1536
+    completion_words: int = 120
+    seed: int = 0
+
+
+def _rng(*parts) -> random.Random:
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "little"))
+
+
+def _resolve(schema: dict, root: dict) -> dict:
+    while "$ref" in schema:
+        path = schema["$ref"].lstrip("#/").split("/")
+        schema = root
+        for part in path:
+            schema = schema[part]
+    return schema
+
+
+def fake_value(
+    schema: dict, rng: random.Random, config: FakeConfig, root=None, name="", index=0
+):
+    """A value following the JSON `schema`, drawn from `rng`."""
+    root = root or schema
+    schema = _resolve(schema, root)
+    options = schema.get("anyOf") or schema.get("oneOf")
+    if options:
+        types = [_resolve(option, root) for option in options]
+        if (
+            any(t.get("type") == "null" for t in types)
+            and rng.random() < config.null_rate
+        ):
+            return None
+        schema = next(t for t in types if t.get("type") != "null")
+    if "allOf" in schema:
+        schema = _resolve(schema["allOf"][0], root)
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+
+    kind = schema.get("type", "object")
+    if isinstance(kind, list):
+        if "null" in kind and rng.random() < config.null_rate:
+            return None
+        kind = next(k for k in kind if k != "null")
+    if kind == "object":
+        return {
+            key: fake_value(value, rng, config, root, key, index)
+            for key, value in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return [
+            fake_value(schema.get("items", {}), rng, config, root, name, i)
+            for i in range(rng.randint(1, 5))
+        ]
+    if kind == "integer":
+        return index + 1 if name == "page" else rng.randint(1, 10**6)
+    if kind == "number":
+        return round(rng.uniform(0.01, 100), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if "date" in name.lower():
+        return (
+            f"{rng.randint(2010, 2024)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+        )
+    return " ".join(rng.choice(words) for _ in range(rng.randint(2, 6))).upper()
+
+
+def chat_completion(body: dict, config: FakeConfig) -> dict:
+    """The deterministic answer to a chat completion request."""
+    rng = _rng(body.get("model"), body.get("messages"), config.seed)
+    message = {"role": "assistant", "content": None}
+    tools = body.get("tools") or []
+    response_format = body.get("response_format") or {}
+    if tools:
+        choice = body.get("tool_choice")
+        name = tools[0]["function"]["name"]
+        if isinstance(choice, dict):
+            name = choice["function"]["name"]
+        function = next(t["function"] for t in tools if t["function"]["name"] == name)
+        arguments = fake_value(function.get("parameters", {}), rng, config)
+        message["tool_calls"] = [
+            {
+                "id": f"call_{rng.getrandbits(48):012x}",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(arguments)},
+            }
+        ]
+    elif response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"].get("schema", {})
+        message["content"] = json.dumps(fake_value(schema, rng, config))
+    elif response_format.get("type") == "json_object":
+        message["content"] = "{}"
+    else:
+        n = max(1, int(config.completion_words * rng.uniform(0.5, 1.5)))
+        message["content"] = " ".join(rng.choice(words) for _ in range(n))
+
+    prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+    completion_tokens = len(json.dumps(message)) // 4
+    return {
+        "id": f"chatcmpl-{rng.getrandbits(64):016x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-3.5-turbo"),
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if tools else "stop",
+                "logprobs": None,
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def embedding_response(body: dict, config: FakeConfig) -> dict:
+    """
+    Unit vectors seeded by each input, which may be a string, a list of strings or,
+    as sent by OpenAIEmbeddings, a list of token lists.
+    """
+    inputs = body.get("input", [])
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    dimensions = body.get("dimensions") or config.dimensions
+    data, tokens = [], 0
+    for i, item in enumerate(inputs):
+        digest = hashlib.sha256(json.dumps([item, config.seed]).encode()).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+        vector = rng.standard_normal(dimensions).astype(np.float32)
+        vector /= np.linalg.norm(vector)
+        if body.get("encoding_format") == "base64":
+            embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode()
+        else:
+            embedding = vector.tolist()
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens += len(item) if isinstance(item, list) else len(item) // 4
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "text-embedding-3-small"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """The HTTP server, holding the configuration and the counts reported by /stats."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: FakeConfig) -> None:
+        super().__init__(address, _Handler)
+        self.config = config
+        self.stats = Counter()
+        self.in_flight = 0
+        self.started = deque()
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+
+    def admit(self) -> Tuple[int, float]:
+        """Decides the fate of a new request: its status code and how long to take."""
+        config = self.config
+        with self._lock:
+            now = time.monotonic()
+            while self.started and now - self.started[0] > 60:
+                self.started.popleft()
+            draw, jitter = self._random.random(), self._random.uniform(-1, 1)
+            if (
+                config.requests_per_minute
+                and len(self.started) >= config.requests_per_minute
+            ):
+                status = 429
+            elif draw < config.rate_limit_rate:
+                status = 429
+            elif draw < config.rate_limit_rate + config.error_rate:
+                status = 500
+            else:
+                status = 200
+                self.started.append(now)
+            self.stats[status] += 1
+            self.in_flight += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self.in_flight
+            )
+        return status, 1 + config.jitter * jitter
+
+    def done(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send(200, dict(self.server.stats))
+        else:
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            answer, latency = chat_completion, self.server.config.latency
+        elif path.endswith("/embeddings"):
+            answer, latency = embedding_response, self.server.config.embedding_latency
+        else:
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        server = self.server
+        status, scale = server.admit()
+        try:
+            if status == 429:
+                retry_after = server.config.retry_after
+                time.sleep(min(latency * scale, 0.05))
+                self._send(
+                    429,
+                    {
+                        "error": {
+                            "message": "Rate limit reached",
+                            "type": "requests",
+                            "code": "rate_limit_exceeded",
+                        }
+                    },
+                    {"Retry-After": f"{retry_after:g}"},
+                )
+            elif status == 500:
+                time.sleep(latency * scale)
+                self._send(
+                    500,
+                    {
+                        "error": {
+                            "message": "The server had an error",
+                            "type": "server_error",
+                        }
+                    },
+                )
+            else:
+                time.sleep(latency * scale)
+                server.stats[path.rsplit("/", 1)[-1]] += 1
+                self._send(200, answer(body, server.config))
+        finally:
+            server.done()
+
+
+def serve(config: FakeConfig = FakeConfig(), host: str = "127.0.0.1", port: int = 0):
+    """
+    Starts the server on a background thread, e.g. for a benchmark in the same process.
+
+    Returns:
+    - Tuple[FakeOpenAI, str]: The server (call `shutdown` when done) and its base URL,
+      to use as `openai_base_url`.
+    """
+    server = FakeOpenAI((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8799)
+    for field, default in FakeConfig._field_defaults.items():
+        parser.add_argument(
+            "--" + field.replace("_", "-"),
+            type=float if isinstance(default, float) else int,
+            default=default,
+        )
+    args = vars(parser.parse_args())
+    host, port = args.pop("host"), args.pop("port")
+    server = FakeOpenAI((host, port), FakeConfig(**args))
+    print(f"Serving on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(dict(server.stats))
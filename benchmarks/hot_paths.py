@@ -0,0 +1,335 @@
+"""
+Timings and peak memory of the CPU hot paths on a synthetic filing (see `synthetic_pdf`),
+compared against baselines recorded on the same machine.
+
+Cases:
+- split_docs:            exhibit splitting of the BODY_CLIP page texts
+- further_split:         splitting of every sentence, and of long unpunctuated runs
+- make_chunks:           one sub-document at a time, with `load_chunker()`
+- make_chunks_fast:      all sub-documents through nlp.pipe, with `load_chunker()`
+- make_chunks_fast[sentencizer]: the same with `load_chunker(rule_based=True)`
+- is_english, is_english_sampled: the language check of every sub-document
+- extract_tables:        text prefilter, find_tables and `manual_table` (`scan_tables`)
+- manual_table:          header mapping and validation of the found tables, then `parse_amounts`
+- join_output:           compression of overlapping retrieved chunks into a prompt
+
+Each case runs once to warm up, is timed `--repeat` times (the best run counts), then
+runs once more under tracemalloc for its peak of Python allocations (memory allocated by
+PyMuPDF or spaCy internals is not traced). Cases that fail, e.g. because their models, corpora
+or settings are missing (en_core_web_sm, the NLTK word list and punkt, an OpenAI key for
+the notice_extraction import), are skipped, and count as regressions if they have a
+baseline.
+
+Run from the repository root:
+    python -m benchmarks.hot_paths --save       # record the baselines of this machine
+    python -m benchmarks.hot_paths --compare    # exit with 1 if a case got slower or bigger
+    python -m benchmarks.hot_paths --pages 200 --table-density 0.3 --only extract_tables
+
+The page texts and table crops are cached in a temporary cache.db for the run, so the
+timings do not depend on, and do not add to, the cache of data/.
+
+Baselines are kept per generator settings in benchmarks/baselines.json, which is not
+committed as timings only compare on the same machine.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+import fitz
+from langchain_core.documents import Document
+from sqlalchemy import create_engine
+
+from benchmarks.synthetic_pdf import make_pdf
+from src.settlement_website_analysis.expense_extraction import (
+    is_expense_header,
+    manual_table,
+    parse_amounts,
+    scan_tables,
+)
+from src.settlement_website_analysis import orm
+from src.settlement_website_analysis.orm import cache_metadata
+from src.settlement_website_analysis.page_text import BODY_CLIP, get_pages
+from src.settlement_website_analysis.summary_extractions import (
+    EnglishRecognizer,
+    further_split,
+    load_chunker,
+    make_chunks,
+    make_chunks_fast,
+    split_docs,
+)
+
+baselines_path = os.path.join(os.path.dirname(__file__), "baselines.json")
+# a case regresses when it is this much slower or bigger than its baseline,
+# beyond a small absolute slack for the cases that only take a few milliseconds
+time_tolerance = 0.25
+memory_tolerance = 0.25
+time_slack = 0.002
+memory_slack = 1 << 16
+
+
+class Filing(NamedTuple):
+    path: str
+    pages: List[str]  # clipped to BODY_CLIP
+    subdocuments: Dict[str, str]
+    maxlen: int
+
+
+cases = {}
+
+
+def case(name: str):
+    """Registers a setup function, which returns the call to measure."""
+
+    def register(setup: Callable[[Filing], Callable[[], object]]):
+        cases[name] = setup
+        return setup
+
+    return register
+
+
+@case("split_docs")
+def _split_docs(filing: Filing):
+    return lambda: split_docs(filing.pages)
+
+
+@case("further_split")
+def _further_split(filing: Filing):
+    sentences = [
+        sentence
+        for text in filing.subdocuments.values()
+        for sentence in re.split(r"(?<=\.) ", text)
+    ]
+    # table dumps come out of the sentence splitter as single, very long "sentences"
+    sentences += [" ".join(f"${i:,}.00" for i in range(400))] * 20
+    return lambda: [further_split(s, filing.maxlen) for s in sentences]
+
+
+def _chunking(filing: Filing, rule_based: bool, fast: bool):
+    nlp = load_chunker(rule_based=rule_based)
+    texts = list(filing.subdocuments.values())
+    nlp.max_length = max(map(len, texts)) + 1
+    if fast:
+        return lambda: make_chunks_fast(texts, nlp=nlp, maxlen=filing.maxlen)
+    return lambda: [make_chunks(t, nlp=nlp, maxlen=filing.maxlen) for t in texts]
+
+
+@case("make_chunks")
+def _make_chunks(filing: Filing):
+    return _chunking(filing, rule_based=False, fast=False)
+
+
+@case("make_chunks_fast")
+def _make_chunks_fast(filing: Filing):
+    return _chunking(filing, rule_based=False, fast=True)
+
+
+@case("make_chunks_fast[sentencizer]")
+def _make_chunks_sentencizer(filing: Filing):
+    return _chunking(filing, rule_based=True, fast=True)
+
+
+@case("is_english")
+def _is_english(filing: Filing):
+    recognizer = EnglishRecognizer()
+    return lambda: [recognizer.is_english(t) for t in filing.subdocuments.values()]
+
+
+@case("is_english_sampled")
+def _is_english_sampled(filing: Filing):
+    recognizer = EnglishRecognizer()
+    return lambda: [
+        recognizer.is_english_sampled(t) for t in filing.subdocuments.values()
+    ]
+
+
+@case("extract_tables")
+def _extract_tables(filing: Filing):
+    return lambda: scan_tables(filing.path)
+
+
+@case("manual_table")
+def _manual_table(filing: Filing):
+    with fitz.open(filing.path) as file:
+        frames = [
+            df
+            for page in file
+            for df in (table.to_pandas() for table in page.find_tables())
+            if is_expense_header(df.columns)
+        ]
+    return lambda: parse_amounts([manual_table(df) for df in frames])
+
+
+@case("join_output")
+def _join_output(filing: Filing):
+    # imported here as notice_extraction sets up its OpenAI clients on import
+    from src.settlement_website_analysis.notice_extraction import join_output
+
+    # windows overlapping by half, like neighbouring TokenTextSplitter chunks
+    text = filing.subdocuments["main"]
+    docs = [
+        Document(text[start : start + 800]) for start in range(0, len(text) - 800, 400)
+    ][:16]
+    return lambda: join_output(docs)
+
+
+@contextlib.contextmanager
+def scratch_cache(folder: str):
+    """
+    Points `orm.cache_engine`, and the modules that imported it, at an empty cache.db
+    in `folder` until the block exits.
+    """
+    engine = create_engine(f"sqlite:///{folder}/cache.db")
+    cache_metadata.create_all(engine)
+    modules = [orm] + [
+        module
+        for name, module in sys.modules.items()
+        if name.startswith("src.settlement_website_analysis.")
+        and getattr(module, "cache_engine", None) is orm.cache_engine
+    ]
+    previous = orm.cache_engine
+    for module in modules:
+        module.cache_engine = engine
+    try:
+        yield
+    finally:
+        for module in modules:
+            module.cache_engine = previous
+        engine.dispose()
+
+
+def measure(func: Callable[[], object], repeat: int) -> Tuple[float, int]:
+    """
+    The best of `repeat` timings, and the peak of traced memory, of `func()`.
+    What it prints (e.g. the token counts of `compress_chunks`) is discarded.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+        seconds = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            seconds = min(seconds, time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def regressions(results: dict, baseline: dict) -> List[str]:
+    """The cases of `results` beyond the tolerances of their `baseline`."""
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["seconds"] > base["seconds"] * (1 + time_tolerance) + time_slack:
+            found.append(f"{name}: {result['seconds']:.4f}s vs {base['seconds']:.4f}s")
+        limit = base["peak_bytes"] * (1 + memory_tolerance) + memory_slack
+        if result["peak_bytes"] > limit:
+            found.append(
+                f"{name}: {result['peak_bytes']:,} bytes vs {base['peak_bytes']:,} bytes"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--exhibits", type=int, default=4)
+    parser.add_argument("--table-density", type=float, default=0.15)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--maxlen", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", choices=list(cases), default=list(cases))
+    parser.add_argument("--save", action="store_true", help="store as the baselines")
+    parser.add_argument(
+        "--compare", action="store_true", help="fail on regressions from the baselines"
+    )
+    args = parser.parse_args()
+
+    settings = (
+        f"pages={args.pages},exhibits={args.exhibits},"
+        f"table_density={args.table_density},seed={args.seed},maxlen={args.maxlen}"
+    )
+    baselines = {}
+    if os.path.exists(baselines_path):
+        with open(baselines_path, encoding="utf-8") as f:
+            baselines = json.load(f)
+    baseline = baselines.get(settings, {})
+    if args.compare and not baseline:
+        sys.exit(f"No baselines for {settings}, record them with --save first")
+
+    with tempfile.TemporaryDirectory() as folder, scratch_cache(folder):
+        path = make_pdf(
+            os.path.join(folder, "filing.pdf"),
+            args.pages,
+            args.exhibits,
+            args.table_density,
+            args.seed,
+        )
+        try:
+            pages = get_pages(path, BODY_CLIP)
+            filing = Filing(path, pages, split_docs(pages), args.maxlen)
+            print(f"{settings}: {len(filing.subdocuments)} sub-documents")
+        except Exception as e:
+            # the cases that need the page texts are skipped below
+            print(f"{settings}: no page texts, {e!r}"[:120])
+            filing = Filing(path, None, None, args.maxlen)
+
+        results = {}
+        for name in args.only:
+            try:
+                func = cases[name](filing)
+                seconds, peak = measure(func, args.repeat)
+                result = {"seconds": seconds, "peak_bytes": peak}
+                if args.compare and regressions({name: result}, baseline):
+                    # measured again before it is reported, as timings are noisy
+                    again = measure(func, args.repeat)
+                    seconds, peak = min(seconds, again[0]), min(peak, again[1])
+            except Exception as e:
+                print(f"{name:32} skipped: {e!r}"[:120])
+                continue
+            results[name] = {"seconds": seconds, "peak_bytes": peak}
+            line = f"{name:32} {seconds:9.4f}s {peak / 2**20:9.2f} MiB"
+            if name in baseline:
+                base = baseline[name]
+                line += (
+                    f"   x{seconds / base['seconds']:.2f} time"
+                    f"   x{peak / max(base['peak_bytes'], 1):.2f} memory"
+                )
+            print(line)
+
+    if args.save:
+        baselines[settings] = baseline | results
+        with open(baselines_path, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} baselines to {baselines_path}")
+    if args.compare:
+        found = regressions(results, baseline)
+        # a case that ran for the baseline but no longer does is a regression too
+        found += [
+            f"{name}: skipped"
+            for name in args.only
+            if name in baseline and name not in results
+        ]
+        for regression in found:
+            print("Regression", regression)
+        if found:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
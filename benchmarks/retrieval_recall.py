@@ -0,0 +1,136 @@
+"""
+Recall of the notice retrieval strategies against the values already in notice_info:
+the share of (notice, field) pairs whose stored value appears in one of the k chunks
+retrieved for that field, and how many chunks each strategy has to embed.
+
+Strategies:
+- dense:  every chunk embedded, top k by cosine similarity (the FAISS index)
+- bm25:   top k by BM25, nothing embedded
+- hybrid: BM25 shortlist, embedded and reranked (`retrieval.HybridSearch`)
+
+Run from the repository root:
+    python -m benchmarks.retrieval_recall --limit 50 --shortlist 12
+"""
+
+import argparse
+import re
+from collections import defaultdict
+from typing import List
+
+import numpy as np
+import pandas as pd
+from langchain_text_splitters import TokenTextSplitter
+
+from src.settlement_website_analysis.assets import data_folder
+from src.settlement_website_analysis.notice_extraction import (
+    ADPS,
+    AttorneyFees,
+    LegalTeam,
+    embedder,
+    embedding_store,
+    chunk_overlap,
+    chunk_size,
+    extract_info,
+)
+from src.settlement_website_analysis.orm import engine
+from src.settlement_website_analysis.page_text import fill, get_pages
+from src.settlement_website_analysis.retrieval import BM25, HybridSearch, tokenize
+
+fields = {LegalTeam: "legal_team", ADPS: "adps", AttorneyFees: "attorney_fees"}
+
+
+def value_patterns(value) -> List[re.Pattern]:
+    """Ways a stored value can be written in the notice."""
+    if isinstance(value, str):
+        # any firm, by its first two words
+        firms = [tokenize(firm)[:2] for firm in re.split(r";|,| and |&", value)]
+        return [
+            re.compile(r"\b" + r"\W+".join(words) + r"\b", re.IGNORECASE)
+            for words in firms
+            if words and len(words[0]) > 2
+        ]
+    numbers = {f"{value:g}", f"{value:.2f}", f"{value:,.2f}"}
+    if value <= 1:
+        numbers |= {f"{value * 100:g}", f"{value:.2f}".lstrip("0")}
+    return [
+        re.compile(r"(?<![\d.])" + re.escape(number) + r"(?!\d)") for number in numbers
+    ]
+
+
+def hit(chunks: List[str], patterns: List[re.Pattern]) -> bool:
+    return any(p.search(chunk) for chunk in chunks for p in patterns)
+
+
+def dense_top(chunks: List[str], query: str, k: int) -> List[str]:
+    vectors = embedding_store.vectors(chunks)
+    query_vector = embedding_store.vectors([query])[0]
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+    similarity = vectors @ query_vector / np.maximum(norms, 1e-12)
+    return [chunks[i] for i in np.argsort(-similarity, kind="stable")[:k]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--limit", type=int, default=None, help="Notices to evaluate")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--shortlist", type=int, default=12)
+    args = parser.parse_args()
+
+    docs = pd.read_sql_table("documents", engine)[
+        lambda x: x.title.str.contains("NOTICE OF")
+        & x.title.str.contains("PROPOSED SETTLEMENT")
+    ].merge(pd.read_sql_table("notice_info", engine), on="case")
+    docs = docs.drop_duplicates("case").head(args.limit)
+    docs["path"] = (
+        data_folder + "legal_docs/" + docs.case + "/" + docs.filename + ".pdf"
+    )
+    fill(docs.path)
+
+    text_splitter = TokenTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    hits = defaultdict(lambda: defaultdict(int))
+    totals = defaultdict(int)
+    embedded = defaultdict(int)
+    for doc in docs.itertuples():
+        chunks = text_splitter.split_text("".join(get_pages(doc.path)))
+        if not chunks:
+            continue
+        bm25 = BM25(chunks)
+        search = HybridSearch(chunks, embedder, shortlist=args.shortlist, k=args.k)
+        embedded["dense"] += len(chunks)
+        embedded["hybrid"] += len(search.shortlisted(extract_info.values()))
+
+        for info, query in extract_info.items():
+            value = getattr(doc, fields[info])
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                continue
+            patterns = value_patterns(value)
+            if not patterns:
+                continue
+            totals[info.__name__] += 1
+            retrieved = {
+                "dense": dense_top(chunks, query, args.k),
+                "bm25": [chunks[i] for i in bm25.top(query, args.k)],
+                "hybrid": [d.page_content for d in search.search(query)],
+            }
+            for strategy, top in retrieved.items():
+                hits[strategy][info.__name__] += hit(top, patterns)
+
+    print(f"{len(docs)} notices, recall@{args.k}")
+    names = list(totals)
+    print(
+        f"{'':8}" + "".join(f"{n:>14}" for n in names + ["all"]) + f"{'embedded':>10}"
+    )
+    for strategy in ("dense", "bm25", "hybrid"):
+        recalls = [hits[strategy][n] / totals[n] for n in names]
+        overall = sum(hits[strategy].values()) / max(sum(totals.values()), 1)
+        print(
+            f"{strategy:8}"
+            + "".join(f"{r:14.1%}" for r in recalls + [overall])
+            + f"{embedded[strategy]:10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
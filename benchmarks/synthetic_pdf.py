@@ -0,0 +1,143 @@
+"""
+Synthetic legal filings for the benchmarks: pages of settlement prose with a running
+header and footer (outside BODY_CLIP), `EXHIBIT X` cover pages splitting the filing into
+sub-documents, and ruled CATEGORY / AMOUNT expense tables on a share of the pages.
+The same arguments always give the same PDF.
+
+Run from the repository root:
+    python -m benchmarks.synthetic_pdf filing.pdf --pages 60 --exhibits 4 --table-density 0.15
+"""
+
+import argparse
+import random
+import string
+
+import fitz
+
+SENTENCES = [
+    "The Settlement Class consists of all persons who purchased common stock during the Class Period.",
+    "Lead Counsel will apply for an award of attorneys' fees not to exceed 25% of the Settlement Fund.",
+    "Pursuant to Rule 23(e) of the Federal Rules of Civil Procedure, the Court held a hearing.",
+    "Defendants deny any wrongdoing, fault, liability or damage whatsoever.",
+    "The Net Settlement Fund will be distributed to Authorized Claimants on a pro rata basis.",
+    "The average recovery per damaged share is estimated at $0.42 before fees and expenses.",
+    "Claims must be postmarked or submitted online no later than the deadline set by the Court.",
+]
+EXPENSES = [
+    "Experts and Consultants",
+    "Court Reporters and Transcripts",
+    "Online Legal and Factual Research",
+    "Mediation Fees",
+    "Photocopying and Printing",
+    "Travel, Meals and Lodging",
+    "Filing and Service Fees",
+    "Document Management and Hosting",
+    "Postage and Overnight Delivery",
+]
+WIDTH, HEIGHT = 612, 792
+MARGIN = 72
+FONT_SIZE = 10
+
+
+def _header(page: fitz.Page, number: int, pages: int):
+    page.insert_text(
+        (MARGIN, 28),
+        f"Case 1:20-cv-01234-ABC Document 56 Filed 01/15/21 Page {number} of {pages}",
+        fontsize=8,
+    )
+    page.insert_text((MARGIN, 760), f"DECLARATION IN SUPPORT - {number}", fontsize=8)
+
+
+def _prose(rng: random.Random, sentences: int) -> str:
+    return " ".join(rng.choice(SENTENCES) for _ in range(sentences))
+
+
+def _expense_table(page: fitz.Page, rng: random.Random, top: float) -> float:
+    """Draws a ruled expense table from `top`, returning where it ends."""
+    rows = [("CATEGORY", "AMOUNT")]
+    total = 0.0
+    for category in rng.sample(EXPENSES, rng.randint(4, len(EXPENSES))):
+        amount = round(rng.uniform(100, 250_000), 2)
+        total += amount
+        rows.append((category, f"${amount:,.2f}"))
+    rows.append(("TOTAL", f"${total:,.2f}"))
+
+    row_height, split, right = 18, 380, WIDTH - MARGIN
+    bottom = top + row_height * len(rows)
+    for i in range(len(rows) + 1):
+        y = top + i * row_height
+        page.draw_line((MARGIN, y), (right, y))
+    for x in (MARGIN, split, right):
+        page.draw_line((x, top), (x, bottom))
+    for i, (category, amount) in enumerate(rows):
+        y = top + i * row_height + 13
+        page.insert_text((MARGIN + 4, y), category, fontsize=FONT_SIZE)
+        page.insert_text((split + 4, y), amount, fontsize=FONT_SIZE)
+    return bottom
+
+
+def make_pdf(
+    path: str,
+    pages: int = 60,
+    exhibits: int = 4,
+    table_density: float = 0.15,
+    seed: int = 0,
+) -> str:
+    """
+    Writes a synthetic filing to `path`.
+
+    Parameters:
+    - path (str): Where to save the PDF.
+    - pages (int): Total number of pages, exhibit covers included.
+    - exhibits (int): Number of `EXHIBIT X` cover pages, spread evenly after the first page.
+    - table_density (float): Share of the other pages carrying an expense table.
+    - seed (int): Seed of the random text, amounts and table placement.
+
+    Returns:
+    - str: `path`.
+    """
+    rng = random.Random(seed)
+    covers = {
+        round(1 + (i + 1) * (pages - 1) / (exhibits + 1)) for i in range(exhibits)
+    }
+    labels = iter(string.ascii_uppercase * 4)
+    body = fitz.Rect(MARGIN, 60, WIDTH - MARGIN, 720)
+
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page(width=WIDTH, height=HEIGHT)
+        _header(page, number + 1, pages)
+        if number in covers:
+            page.insert_text((260, 400), f"EXHIBIT {next(labels)}", fontsize=16)
+            continue
+        if number and rng.random() < table_density:
+            page.insert_textbox(
+                fitz.Rect(MARGIN, 60, WIDTH - MARGIN, 200),
+                "SUMMARY OF LITIGATION EXPENSES INCURRED BY LEAD COUNSEL. "
+                + _prose(rng, 4),
+                fontsize=FONT_SIZE,
+            )
+            end = _expense_table(page, rng, 210)
+            page.insert_textbox(
+                fitz.Rect(MARGIN, end + 20, WIDTH - MARGIN, 720),
+                _prose(rng, 6),
+                fontsize=FONT_SIZE,
+            )
+        else:
+            page.insert_textbox(body, _prose(rng, 30), fontsize=FONT_SIZE)
+    # no dates or file id, so that the same arguments give the same bytes (and hash)
+    doc.set_metadata({})
+    doc.save(path, garbage=3, deflate=True, no_new_id=True)
+    doc.close()
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("path")
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--exhibits", type=int, default=4)
+    parser.add_argument("--table-density", type=float, default=0.15)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(make_pdf(args.path, args.pages, args.exhibits, args.table_density, args.seed))
@@ -1,11 +1,46 @@
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
 import pandas as pd
 import requests
-import os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 api_key = os.getenv("openai_api")
+# alternative OpenAI-compatible endpoint, e.g. a proxy or a local test server
+base_url = os.getenv("openai_base_url")
 
 data_folder = "data/"
-sites = pd.read_csv(data_folder + "Securities Settlement Websites.csv")
+
+# (connect, read) timeout in seconds for every request made through `get`
+timeout = (10, 60)
+# maximum number of requests in flight against a single host
+max_per_host = 4
+# size of the pieces in which downloads are streamed to disk
+chunk_size = 1 << 16
+# downloads larger than this many bytes are abandoned (None disables the guard)
+max_download_bytes = None
+# number of worker threads used to fan out over documents and sites
+max_workers = 16
+
+_sessions = {}
+_host_slots = {}
+_lock = threading.Lock()
+
+
+def load_sites() -> pd.DataFrame:
+    """
+    Read the list of companies and their settlement websites.
+
+    Returns:
+    - pd.DataFrame: One row per company, with its Website.
+    """
+    return pd.read_csv(data_folder + "Securities Settlement Websites.csv")
 
 
 class RequestError(Exception):
@@ -15,6 +50,17 @@ class RequestError(Exception):
         self.url = url
 
 
+class DownloadTooLarge(RequestError):
+    pass
+
+
+class Download(NamedTuple):
+    size: int
+    sha256: str
+    etag: str
+    last_modified: str
+
+
 class Website:
     def __init__(self, url, name) -> None:
         self.url = url
@@ -23,12 +69,122 @@ class Website:
         self.docs_page = None
 
 
-def get(url):
-    response = requests.get(url)
-    if response.status_code != 200:
+def _session(host):
+    """
+    Returns the keep-alive session and concurrency slot for a host, creating them on first use.
+    Retries with exponential backoff on connection errors and on 429/5xx responses.
+    """
+    with _lock:
+        if host not in _sessions:
+            retry = Retry(
+                total=5,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "HEAD"],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=max_per_host, max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+            _host_slots[host] = threading.BoundedSemaphore(max_per_host)
+        return _sessions[host], _host_slots[host]
+
+
+def _check(response, url, conditional=False):
+    if response.status_code != 200 and not (
+        conditional and response.status_code == 304
+    ):
         raise RequestError(
             f"error {response.status_code}, page: {url}",
             status_code=response.status_code,
             url=url,
         )
+
+
+def get(url, headers=None):
+    """
+    Fetches `url`, raising RequestError unless it answers 200
+    (or 304 when conditional `headers` such as If-None-Match are passed).
+    """
+    session, slot = _session(urlsplit(url).netloc)
+    with slot:
+        response = session.get(url, timeout=timeout, headers=headers)
+    _check(response, url, conditional=bool(headers))
     return response
+
+
+def download(url, path, max_bytes=None, headers=None):
+    """
+    Streams `url` to `path` in chunks, so at most `chunk_size` bytes are held in memory.
+    The body is written to a temporary file next to `path` and renamed into place once
+    complete, so an interrupted download never leaves a truncated file at `path`.
+
+    Parameters:
+    - url (str): The address of the document.
+    - path (str): Where to save the document.
+    - max_bytes (int): Abandon the download beyond this size (defaults to `max_download_bytes`).
+    - headers (dict): Conditional request headers, e.g. from `Manifest.headers`.
+
+    Returns:
+    - Download: Size, SHA-256 and validators of the saved file, or None if the server
+      answered 304 Not Modified.
+    """
+    max_bytes = max_bytes or max_download_bytes
+    session, slot = _session(urlsplit(url).netloc)
+    with slot, session.get(
+        url, timeout=timeout, stream=True, headers=headers
+    ) as response:
+        _check(response, url, conditional=bool(headers))
+        if response.status_code == 304:
+            return None
+        length = response.headers.get("Content-Length")
+        if max_bytes and length and int(length) > max_bytes:
+            raise DownloadTooLarge(
+                f"{length} bytes, page: {url}",
+                status_code=response.status_code,
+                url=url,
+            )
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or ".", suffix=".part"
+        )
+        size = 0
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in response.iter_content(chunk_size):
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise DownloadTooLarge(
+                            f"over {max_bytes} bytes, page: {url}",
+                            status_code=response.status_code,
+                            url=url,
+                        )
+                    digest.update(chunk)
+                    file.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return Download(
+        size,
+        digest.hexdigest(),
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+    )
+
+
+def pool_map(func, items, workers=None):
+    """
+    Applies `func` to every item on a thread pool and returns the results in order.
+    Per-host limits are enforced by `get`, so items may freely target the same host.
+    """
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(min(workers or max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
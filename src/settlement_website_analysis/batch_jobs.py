@@ -0,0 +1,202 @@
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import openai
+from langchain_core.messages import convert_to_openai_messages
+from langchain_core.prompt_values import PromptValue
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_openai import ChatOpenAI
+
+from src.settlement_website_analysis.assets import api_key, base_url, data_folder
+from src.settlement_website_analysis.clients import chat_limiter
+from src.settlement_website_analysis.rate_limit import RateLimitedTransport
+
+batch_folder = data_folder + "batches/"
+# seconds between two checks of a submitted job
+poll_interval = 60
+endpoint = "/v1/chat/completions"
+
+
+def chat_request(
+    custom_id: str, llm: ChatOpenAI, prompt: PromptValue, schema=None
+) -> dict:
+    """
+    One line of a batch job: the chat completion `llm` would send for `prompt`,
+    forcing a call of the `schema` tool for structured output if given.
+
+    Parameters:
+    - custom_id (str): Identifies the request in the results, e.g. a JSON encoded key.
+    - llm (ChatOpenAI): The model and sampling settings to use.
+    - prompt (PromptValue): The formatted prompt, e.g. `prompt.invoke(values)`.
+    - schema: Optional pydantic model the answer must follow.
+
+    Returns:
+    - dict: The request, see `write_job`.
+    """
+    body = {
+        "model": llm.model_name,
+        "messages": convert_to_openai_messages(prompt.to_messages()),
+    }
+    if llm.temperature is not None:
+        body["temperature"] = llm.temperature
+    if schema is not None:
+        tool = convert_to_openai_tool(schema)
+        body["tools"] = [tool]
+        body["tool_choice"] = {
+            "type": "function",
+            "function": {"name": tool["function"]["name"]},
+        }
+    return {"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}
+
+
+def write_job(name: str, requests: List[dict]) -> str:
+    """Writes the requests of a job to `data/batches/<name>-<timestamp>.jsonl`."""
+    ids = [request["custom_id"] for request in requests]
+    if len(set(ids)) != len(ids):
+        # their completions would overwrite each other in `run_job`
+        raise ValueError(f"custom_id must be unique within a batch job ({name})")
+    os.makedirs(batch_folder, exist_ok=True)
+    path = f"{batch_folder}{name}-{int(time.time())}.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+    return path
+
+
+class OpenAIBatches:
+    """Runs job files through the OpenAI Batch API (results within 24 hours, at half price)."""
+
+    def __init__(self) -> None:
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url)
+
+    def submit(self, path: str) -> str:
+        with open(path, "rb") as f:
+            file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=file.id, endpoint=endpoint, completion_window="24h"
+        )
+        return batch.id
+
+    def status(self, job_id: str) -> str:
+        return self.client.batches.retrieve(job_id).status
+
+    def results(self, job_id: str) -> List[dict]:
+        batch = self.client.batches.retrieve(job_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text = self.client.files.content(file_id).text
+                lines += [json.loads(line) for line in text.splitlines() if line]
+        return lines
+
+
+class LocalBatches:
+    """
+    File-based stand-in for `OpenAIBatches`: the job is answered on submission by
+    `respond`, which maps a request body to a chat completion, and the results are
+    written next to the job file in the Batch API output format.
+    By default requests are sent one by one to the chat completions endpoint.
+    """
+
+    def __init__(self, respond: Callable[[dict], dict] = None) -> None:
+        self.respond = respond
+        if respond is None:
+            self.client = openai.OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=httpx.Client(transport=RateLimitedTransport(chat_limiter)),
+                max_retries=0,
+            )
+            self.respond = self._complete
+
+    def _complete(self, body: dict) -> dict:
+        return self.client.chat.completions.create(**body).model_dump()
+
+    def submit(self, path: str) -> str:
+        output = path[: -len(".jsonl")] + ".output.jsonl"
+        with open(path, encoding="utf-8") as f, open(output, "w") as out:
+            for line in f:
+                request = json.loads(line)
+                try:
+                    response = {
+                        "status_code": 200,
+                        "body": self.respond(request["body"]),
+                    }
+                    error = None
+                except Exception as e:
+                    response, error = None, {"message": repr(e)}
+                result = {
+                    "id": request["custom_id"],
+                    "custom_id": request["custom_id"],
+                    "response": response,
+                    "error": error,
+                }
+                out.write(json.dumps(result) + "\n")
+        return output
+
+    def status(self, job_id: str) -> str:
+        return "completed" if os.path.exists(job_id) else "in_progress"
+
+    def results(self, job_id: str) -> List[dict]:
+        with open(job_id, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def run_job(name: str, requests: List[dict], backend=None) -> Dict[str, Optional[dict]]:
+    """
+    Writes, submits and waits for a batch job.
+
+    Parameters:
+    - name (str): Prefix of the job file.
+    - requests (List[dict]): See `chat_request`.
+    - backend: `OpenAIBatches` (default) or `LocalBatches`.
+
+    Returns:
+    - Dict[str, Optional[dict]]: The chat completion of each custom_id, None if it failed.
+    """
+    if not requests:
+        return {}
+    backend = backend or OpenAIBatches()
+    path = write_job(name, requests)
+    job_id = backend.submit(path)
+    print(f"Submitted {len(requests)} requests from {path} as {job_id}")
+    while (status := backend.status(job_id)) not in (
+        "completed",
+        "failed",
+        "expired",
+        "cancelled",
+    ):
+        print(f"{job_id}: {status}")
+        time.sleep(poll_interval)
+
+    completions = {request["custom_id"]: None for request in requests}
+    if status != "completed":
+        print(f"{job_id}: {status}")
+    for result in backend.results(job_id) if status == "completed" else []:
+        response = result.get("response") or {}
+        if response.get("status_code") == 200:
+            completions[result["custom_id"]] = response["body"]
+        else:
+            print(f"Failed {result['custom_id']}: {result.get('error') or response}")
+    return completions
+
+
+def content(completion: Optional[dict]) -> Optional[str]:
+    """The text answer of a chat completion."""
+    if completion is None:
+        return None
+    return completion["choices"][0]["message"]["content"]
+
+
+def structured(completion: Optional[dict], schema):
+    """The `schema` instance of a structured-output request, None if missing or invalid."""
+    if completion is None:
+        return None
+    tool_calls = completion["choices"][0]["message"].get("tool_calls") or []
+    try:
+        return schema.parse_raw(tool_calls[0]["function"]["arguments"])
+    except (IndexError, KeyError, ValueError):
+        return None
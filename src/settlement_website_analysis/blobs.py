@@ -0,0 +1,183 @@
+import hashlib
+import os
+import tempfile
+from typing import Iterable, Set, Tuple
+
+from sqlalchemy import delete, insert, select
+
+from src.settlement_website_analysis.assets import data_folder
+from src.settlement_website_analysis.orm import blobs_table, engine, processed_table
+
+blob_folder = data_folder + "blobs/"
+
+
+def blob_path(sha256: str) -> str:
+    return f"{blob_folder}{sha256[:2]}/{sha256}.pdf"
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store(path: str, case: str, filename: str, sha256: str = None) -> str:
+    """
+    Stores the PDF at `path` once by content, and records which blob `(case, filename)` is.
+    `path` is kept as a hard link to the blob, so code reading
+    `legal_docs/<case>/<filename>.pdf` is unaffected while duplicates take no extra space.
+
+    Parameters:
+    - path (str): The downloaded PDF.
+    - case (str): The case the document belongs to.
+    - filename (str): The document name within the case (without extension).
+    - sha256 (str): The content hash, if already known.
+
+    Returns:
+    - str: The SHA-256 of the document.
+    """
+    sha256 = sha256 or file_hash(path)
+    target = blob_path(sha256)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(path, target)
+    except FileExistsError:
+        if not os.path.samefile(path, target):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+            os.close(fd)
+            os.remove(tmp_path)
+            os.link(target, tmp_path)
+            os.replace(tmp_path, path)
+    except OSError:
+        # no hard link support (e.g. across devices): keep a copy, dedupe on hash only
+        pass
+
+    with engine.connect() as conn:
+        _ = conn.execute(
+            delete(blobs_table).where(
+                blobs_table.c.case == case, blobs_table.c.filename == filename
+            )
+        )
+        _ = conn.execute(
+            insert(blobs_table).values(case=case, filename=filename, sha256=sha256)
+        )
+        conn.commit()
+    return sha256
+
+
+def blob_hash(case: str, filename: str) -> str:
+    """
+    The SHA-256 of a document, registering it in the store if it predates it.
+    Returns None if the document was never downloaded.
+    """
+    with engine.connect() as conn:
+        sha256 = conn.execute(
+            select(blobs_table.c.sha256).where(
+                blobs_table.c.case == case, blobs_table.c.filename == filename
+            )
+        ).scalar()
+    if sha256 is None:
+        path = f"{data_folder}legal_docs/{case}/{filename}.pdf"
+        if os.path.exists(path):
+            sha256 = store(path, case, filename)
+    return sha256
+
+
+def duplicate_rows(conn, table, case: str, filename: str) -> list:
+    """
+    Output rows another `(case, filename)` with identical content already has in `table`,
+    rewritten for this document, so a stage can reuse them instead of reprocessing.
+    Tables without a filename column (e.g. one row per case) are matched on case only.
+
+    Returns:
+    - list: Rows ready to insert, empty if no duplicate has been processed yet.
+    """
+    sha256 = blob_hash(case, filename)
+    if sha256 is None:
+        return []
+    siblings = conn.execute(
+        select(blobs_table.c.case, blobs_table.c.filename).where(
+            blobs_table.c.sha256 == sha256,
+            (blobs_table.c.case != case) | (blobs_table.c.filename != filename),
+        )
+    ).all()
+    for other_case, other_filename in siblings:
+        if "filename" not in table.c and other_case == case:
+            continue
+        where = [table.c.case == other_case]
+        if "filename" in table.c:
+            where.append(table.c.filename == other_filename)
+        rows = conn.execute(select(table).where(*where)).mappings().all()
+        if rows:
+            keys = {"case": case}
+            if "filename" in table.c:
+                keys["filename"] = filename
+            return [dict(row) | keys for row in rows]
+    return []
+
+
+def changed_documents(
+    stage: str, pairs: Iterable[Tuple[str, str]]
+) -> Set[Tuple[str, str]]:
+    """
+    The (case, filename) pairs whose content changed since `stage` last processed them,
+    i.e. whose blob hash differs from the one recorded by `mark_processed`. Each stage
+    keeps its own records, so reprocessing a document in one stage does not hide the
+    change from the others, and a document is no longer reported once reprocessed.
+
+    Pairs without a record are new documents, and reported too, unless the stage has no
+    records at all yet: its first run records every pair at its current hash, so that
+    the output from before the records existed is not redone.
+
+    Parameters:
+    - stage (str): The stage, e.g. the name of its output table.
+    - pairs: The documents the stage works on.
+
+    Returns:
+    - Set[Tuple[str, str]]: The pairs to process again, replacing their old output.
+    """
+    changed, unrecorded = set(), []
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(
+                processed_table.c.case,
+                processed_table.c.filename,
+                processed_table.c.sha256,
+            ).where(processed_table.c.stage == stage)
+        )
+        recorded = {(case, filename): sha256 for case, filename, sha256 in rows}
+    for case, filename in set(pairs):
+        sha256 = blob_hash(case, filename)
+        if sha256 is None:
+            continue
+        if not recorded:
+            unrecorded.append({"case": case, "filename": filename, "sha256": sha256})
+        elif recorded.get((case, filename)) != sha256:
+            changed.add((case, filename))
+    if unrecorded:
+        with engine.connect() as conn:
+            _ = conn.execute(
+                insert(processed_table).values(
+                    [row | {"stage": stage} for row in unrecorded]
+                )
+            )
+            conn.commit()
+    return changed
+
+
+def mark_processed(stage: str, pairs: Iterable[Tuple[str, str]]):
+    """Records the current content of the (case, filename) pairs as processed by `stage`."""
+    rows = []
+    for case, filename in set(pairs):
+        sha256 = blob_hash(case, filename)
+        if sha256 is not None:
+            rows.append(
+                {"stage": stage, "case": case, "filename": filename, "sha256": sha256}
+            )
+    if not rows:
+        return
+    with engine.connect() as conn:
+        _ = conn.execute(insert(processed_table).prefix_with("OR REPLACE").values(rows))
+        conn.commit()
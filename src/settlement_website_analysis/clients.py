@@ -0,0 +1,50 @@
+import httpx
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from src.settlement_website_analysis.assets import api_key, base_url
+from src.settlement_website_analysis.llm_cache import llm_cache
+from src.settlement_website_analysis.rate_limit import (
+    AsyncRateLimitedTransport,
+    RateLimitedTransport,
+    RateLimiter,
+)
+
+# account limits, shared by the threads and coroutines of this process; lower them
+# when several scripts run against the API at once
+chat_limiter = RateLimiter("chat", requests_per_minute=500, tokens_per_minute=200_000)
+embeddings_limiter = RateLimiter(
+    "embeddings", requests_per_minute=3000, tokens_per_minute=1_000_000
+)
+
+
+def _http_clients(limiter: RateLimiter) -> dict:
+    # retries happen in the transports, where they are rate limited too
+    return {
+        "http_client": httpx.Client(transport=RateLimitedTransport(limiter)),
+        "http_async_client": httpx.AsyncClient(
+            transport=AsyncRateLimitedTransport(limiter)
+        ),
+        "max_retries": 0,
+    }
+
+
+def chat_model(**kwargs) -> ChatOpenAI:
+    """A ChatOpenAI going through the shared chat rate limiter and the LLM cache."""
+    kwargs = {"cache": llm_cache} | kwargs
+    return ChatOpenAI(
+        api_key=api_key, base_url=base_url, **_http_clients(chat_limiter), **kwargs
+    )
+
+
+def embeddings(**kwargs) -> OpenAIEmbeddings:
+    """An OpenAIEmbeddings going through the shared embeddings rate limiter."""
+    return OpenAIEmbeddings(
+        api_key=api_key,
+        base_url=base_url,
+        **_http_clients(embeddings_limiter),
+        **kwargs,
+    )
+
+
+def limiter_stats() -> list:
+    return [chat_limiter.stats(), embeddings_limiter.stats()]
@@ -0,0 +1,110 @@
+import re
+from typing import List
+
+import tiktoken
+
+# short lines that are navigation, footers or calls to action rather than content;
+# links and copyright notices are capped at a few words, so that a sentence of the
+# notice starting with "Click here" or "Copyright" is kept
+boilerplate_pattern = re.compile(
+    r"(home|menu|search|back to top|skip to (main )?content|contact( us)?|faqs?|"
+    r"frequently asked questions|important (dates|documents)|documents|"
+    r"submit (a )?claim( online)?|file a claim|print( this page)?|"
+    r"click here(( to| for)( [\w'’]+){1,6})?\.?|"
+    r"privacy policy|terms of use|disclaimer|accessibility|english|español|"
+    r"(copyright( ©)?|©)( \d{4}([-–]\d{4})?,?( [\w&.,'’-]+){0,8}"
+    r"( all rights reserved\.?)?)?|"
+    r"all rights reserved\.?)",
+    re.IGNORECASE,
+)
+# overlaps shorter than this are left alone, they are as likely to be coincidental
+min_overlap = 20
+
+_encoding = None
+
+
+def _encode(text: str) -> List[int]:
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding.encode(text, disallowed_special=())
+
+
+def count_tokens(text: str) -> int:
+    return len(_encode(text))
+
+
+def trim_tokens(text: str, max_tokens: int) -> str:
+    """The longest prefix of `text` within `max_tokens` tokens."""
+    tokens = _encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return _encoding.decode(tokens[:max_tokens])
+
+
+def clean_lines(text: str) -> str:
+    """Drops empty, boilerplate and repeated lines, keeping the first of each."""
+    seen, lines = set(), []
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        key = line.lower()
+        if not line or key in seen or boilerplate_pattern.fullmatch(line):
+            continue
+        seen.add(key)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of `a` that is also a prefix of `b`."""
+    for n in range(min(len(a), len(b)), min_overlap - 1, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+
+def remove_overlaps(chunks: List[str]) -> List[str]:
+    """
+    Removes the text chunks share, e.g. the overlap of neighbouring `TokenTextSplitter`
+    chunks retrieved together: chunks contained in an earlier one are dropped, and a
+    prefix or suffix already present at the edge of an earlier chunk is cut.
+    """
+    kept = []
+    for chunk in chunks:
+        if any(chunk in other for other in kept):
+            continue
+        for other in kept:
+            chunk = chunk[_overlap(other, chunk) :]
+            if n := _overlap(chunk, other):
+                chunk = chunk[:-n]
+        if chunk.strip():
+            kept.append(chunk)
+    return kept
+
+
+def compress(text: str, max_tokens: int, label: str = "") -> str:
+    """
+    Shrinks a prompt input before it is sent to the LLM: boilerplate and repeated lines
+    are dropped and the rest is cut to `max_tokens`. Prints the token counts.
+    """
+    before = count_tokens(text)
+    text = trim_tokens(clean_lines(text), max_tokens)
+    print(f"{label} tokens: {before} -> {count_tokens(text)}")
+    return text
+
+
+def compress_chunks(chunks: List[str], max_tokens: int, label: str = "") -> List[str]:
+    """
+    Like `compress` for retrieved chunks: overlaps are removed, and chunks are kept in
+    order until `max_tokens` is reached, the last one cut to fit.
+    """
+    before = sum(map(count_tokens, chunks))
+    budget, kept = max_tokens, []
+    for chunk in remove_overlaps(chunks):
+        if budget <= 0:
+            break
+        chunk = trim_tokens(chunk, budget)
+        budget -= count_tokens(chunk)
+        kept.append(chunk)
+    print(f"{label} tokens: {before} -> {sum(map(count_tokens, kept))}")
+    return kept
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List
+
+import numpy as np
+import tiktoken
+from langchain_core.embeddings import Embeddings
+from sqlalchemy import insert, select
+
+from src.settlement_website_analysis.assets import data_folder
+from src.settlement_website_analysis.orm import cache_engine, embeddings_table
+
+store_folder = data_folder + "embeddings/"
+# OpenAI limits: inputs per request, tokens per request, and our tokens-per-minute budget
+max_batch_size = 2048
+max_batch_tokens = 250_000
+tokens_per_minute = 1_000_000
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Shared, append-only store of text embeddings for one model.
+
+    Vectors live in a single float32 file (`data/embeddings/<model>.f32`, read through
+    np.memmap) and the embeddings table of cache.db maps each text hash to its row, so
+    identical chunks are only ever embedded once across documents, stages and runs.
+    """
+
+    def __init__(self, embedder: Embeddings, model: str) -> None:
+        self.embedder = embedder
+        self.model = model
+        self.path = f"{store_folder}{model}.f32"
+        self.dim_path = f"{store_folder}{model}.dim"
+        self.dim = None
+        if os.path.exists(self.dim_path):
+            with open(self.dim_path) as f:
+                self.dim = int(f.read())
+        self._rows: Dict[str, int] = {}
+        # hash -> event set once the thread embedding that text is done with it
+        self._in_flight: Dict[str, threading.Event] = {}
+        self._sent = deque()
+        self._lock = threading.Lock()
+        self._budget_lock = threading.Lock()
+        # loaded on first use, the encoding may have to be downloaded
+        self._encoding = None
+
+    def _lookup(self, hashes: Iterable[str]) -> Dict[str, int]:
+        missing = [h for h in set(hashes) if h not in self._rows]
+        with cache_engine.connect() as conn:
+            for i in range(0, len(missing), 500):
+                rows = conn.execute(
+                    select(embeddings_table.c.text_hash, embeddings_table.c.row).where(
+                        embeddings_table.c.model == self.model,
+                        embeddings_table.c.text_hash.in_(missing[i : i + 500]),
+                    )
+                )
+                self._rows.update(dict(rows.all()))
+        return self._rows
+
+    def _throttle(self, tokens: int):
+        """Waits until sending `tokens` more keeps us under `tokens_per_minute`."""
+        with self._budget_lock:
+            self._wait_for_budget(tokens)
+
+    def _wait_for_budget(self, tokens: int):
+        while True:
+            now = time.monotonic()
+            while self._sent and now - self._sent[0][0] > 60:
+                self._sent.popleft()
+            used = sum(n for _, n in self._sent)
+            if not self._sent or used + tokens <= tokens_per_minute:
+                self._sent.append((now, tokens))
+                return
+            time.sleep(max(0, 60 - (now - self._sent[0][0])))
+
+    def _batches(self, texts: List[str]):
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = len(self._encoding.encode(text, disallowed_special=()))
+            if batch and (
+                len(batch) == max_batch_size or batch_tokens + tokens > max_batch_tokens
+            ):
+                yield batch, batch_tokens
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch, batch_tokens
+
+    def _append(self, texts: List[str], vectors: np.ndarray):
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            os.makedirs(store_folder, exist_ok=True)
+            with open(self.dim_path, "w") as f:
+                f.write(str(self.dim))
+        row_bytes = self.dim * 4
+        with cache_engine.connect() as conn:
+            # the write lock on cache.db serialises appends across processes
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            with open(self.path, "ab") as f:
+                start = -(-f.tell() // row_bytes)
+                f.truncate(start * row_bytes)
+                f.write(vectors.astype(np.float32).tobytes())
+            rows = {text_hash(t): start + i for i, t in enumerate(texts)}
+            _ = conn.execute(
+                insert(embeddings_table)
+                .prefix_with("OR IGNORE")
+                .values(
+                    [
+                        {"model": self.model, "text_hash": h, "row": row}
+                        for h, row in rows.items()
+                    ]
+                )
+            )
+            conn.commit()
+        self._rows.update(rows)
+
+    def embed_pending(self, texts: Iterable[str]) -> int:
+        """
+        Embeds every text not in the store yet, deduplicated and sent in maximal batches.
+        The lock only covers the bookkeeping, not the requests: texts another thread is
+        already embedding are waited for rather than sent twice, and embedded here if
+        that thread failed.
+
+        Returns:
+        - int: The number of texts that had to be embedded.
+        """
+        unique = {text_hash(t): t for t in texts}
+        embedded = 0
+        while unique:
+            done = threading.Event()
+            with self._lock:
+                known = self._lookup(unique)
+                missing = [h for h in unique if h not in known]
+                waiting = {
+                    h: self._in_flight[h] for h in missing if h in self._in_flight
+                }
+                claimed = [h for h in missing if h not in waiting]
+                for h in claimed:
+                    self._in_flight[h] = done
+            try:
+                for batch, tokens in self._batches([unique[h] for h in claimed]):
+                    self._throttle(tokens)
+                    vectors = np.array(self.embedder.embed_documents(batch))
+                    with self._lock:
+                        self._append(batch, vectors)
+                embedded += len(claimed)
+            finally:
+                with self._lock:
+                    for h in claimed:
+                        del self._in_flight[h]
+                done.set()
+            for event in waiting.values():
+                event.wait()
+            # check again the texts of the other threads, in case they failed
+            unique = {h: unique[h] for h in waiting}
+        return embedded
+
+    def vectors(self, texts: List[str]) -> np.ndarray:
+        """The stored vectors of `texts`, embedding any that are missing."""
+        self.embed_pending(texts)
+        rows = [self._rows[text_hash(t)] for t in texts]
+        matrix = np.memmap(self.path, dtype=np.float32, mode="r")
+        # only the requested rows are read from disk
+        return matrix[: len(matrix) // self.dim * self.dim].reshape(-1, self.dim)[rows]
+
+
+class StoredEmbeddings(Embeddings):
+    """LangChain embeddings backed by an EmbeddingStore, for FAISS and the document filters."""
+
+    def __init__(self, store: EmbeddingStore) -> None:
+        self.store = store
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.store.vectors(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.store.vectors([text])[0].tolist()
@@ -1,17 +1,29 @@
-import base64
-from typing import Optional, List, Tuple
+import asyncio
+import re
+import time
+from itertools import accumulate
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 import fitz
 import pandas as pd
 from joblib import Parallel, delayed
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain_openai import ChatOpenAI
 from numpy import nan
-from sqlalchemy import insert
-
-from src.settlement_website_analysis.assets import api_key, data_folder
-from src.settlement_website_analysis.orm import engine, expenses_table
+from sqlalchemy import delete, insert, tuple_
+
+from src.settlement_website_analysis.assets import data_folder
+from src.settlement_website_analysis.blobs import (
+    blob_hash,
+    changed_documents,
+    duplicate_rows,
+    file_hash,
+    mark_processed,
+)
+from src.settlement_website_analysis.clients import chat_model
+from src.settlement_website_analysis.orm import create_tables, engine, expenses_table
+from src.settlement_website_analysis.page_text import fill, get_pages
+from src.settlement_website_analysis.table_crops import crop, default_dpi, load_crops
 
 
 class ExpenseRow(BaseModel):
@@ -40,7 +52,25 @@ class InvalidTableFormat(Exception):
     pass
 
 
-def extract_tables(case: str, filename: str) -> List[Tuple[int, str, pd.DataFrame]]:
+# resolution of the table crops sent to the vision model, None to pick the lowest
+# legible one per table (see `table_crops.adaptive_dpi`)
+crop_dpi = default_dpi
+
+
+class PageScan(NamedTuple):
+    pages: int
+    skipped: int
+    seconds: float  # spent in find_tables on the pages that were not skipped
+
+
+# a table is either parsed by `manual_table` or left as the hash of its cached crop
+# for the vision model
+PageTables = List[Tuple[int, str, List[Union[pd.DataFrame, str]]]]
+
+
+def extract_tables(
+    case: str, filename: str, sha256: str = None
+) -> Tuple[PageTables, PageScan]:
     """
     Extracts relevant tables from a PDF document based on specific column criteria and processes them.
 
@@ -50,16 +80,22 @@ def extract_tables(case: str, filename: str) -> List[Tuple[int, str, pd.DataFram
         The name or identifier of the legal case. Used to build the path to the PDF file.
     filename : str
         The name of the PDF file (without the extension) from which tables are extracted.
+    sha256 : str, optional
+        The hash of the PDF file if already known (see `blobs.blob_hash`), else it is computed.
 
     Returns:
     --------
-    List[Tuple[int, str, pd.DataFrame]] or None
+    Tuple[PageTables or None, PageScan]
         A list of tuples, where each tuple contains:
         - `page_num` (int): The page number where the table was found.
         - `page_text` (str): The text content of the page where the table was found.
-        - `table` (pd.DataFrame): The extracted and processed table in the form of a Pandas DataFrame.
+        - `tables` (List[pd.DataFrame or str]): The tables of the page, in order. Each is either
+          the processed DataFrame or, if its format is not recognised, the hash of the image
+          of the table (see `table_crops.crop`) to be read by `read_crops`.
 
-        If the PDF file is not found or cannot be opened, the function returns `None`.
+        If the PDF file is not found or cannot be opened, the list is `None`.
+        The PageScan counts the pages skipped by the text prefilter and the time spent
+        detecting tables on the others.
 
     Raises:
     -------
@@ -70,93 +106,237 @@ def extract_tables(case: str, filename: str) -> List[Tuple[int, str, pd.DataFram
 
     Notes:
     ------
-    - The function looks for tables that contain the column "AMOUNT" and exclude the columns "NARRATIVE" and "HOURS".
-    - It uses manual processing (`manual_table`) for valid table formats or a language model (`llm_table`) for fallback in case of invalid formats.
-    - Multiple tables on the same page are concatenated into one DataFrame before appending them to the result list.
+    - Pages whose cached text has none of the `table_cues` are skipped without running `find_tables`.
+    - The function looks for tables that contain an amount column and exclude the columns "NARRATIVE" and "HOURS",
+      see `is_expense_header`.
+    - It uses manual processing (`manual_table`) for valid table formats and renders the other ones with `table_crops.crop`,
+      so that this CPU-bound step never waits on the vision model.
 
     Example:
     --------
     >>> extract_tables("case_123", "document")
-    [(1, "Page 1 text content", DataFrame), (2, "Page 2 text content", DataFrame)]
+    ([(1, "Page 1 text content", [DataFrame]), (2, "Page 2 text content", [DataFrame, "iVBORw0..."])], PageScan(pages=12, skipped=10, seconds=0.8))
     """
+    return scan_tables(f"{data_folder}legal_docs/{case}/{filename}.pdf", sha256)
 
-    path = f"{data_folder}legal_docs/{case}/{filename}.pdf"
+
+def scan_tables(path: str, sha256: str = None) -> Tuple[PageTables, PageScan]:
+    """
+    `extract_tables` for the PDF at `path`, e.g. a synthetic one in the benchmarks.
+    `sha256` is its hash if already known, see `blobs.file_hash`.
+    """
     try:
         file = fitz.open(path)
     except (fitz.FileDataError, fitz.FileNotFoundError):
-        return None
+        return None, PageScan(0, 0, 0.0)
 
+    sha256 = sha256 or file_hash(path)
+    texts = get_pages(path, sha256=sha256)
     tables = []
-    for page_num, page in enumerate(file):
-        ts = []
-        for table in page.find_tables():
-            df = table.to_pandas()
-            if (
-                "AMOUNT" in df.columns
-                and not df.columns.isin(["NARRATIVE", "HOURS"]).any()
-            ):
-                ts.append(table)
-
-        if ts:
-            tbls = []
-            for table in ts:
-                try:
-                    tbls.append(manual_table(table.to_pandas()))
-                except (InvalidTableFormat, ValueError):
-                    tbls.append(llm_table(page, table))
-            table = pd.concat(tbls)
-            tables.append((page_num, page.get_text(), table))
+    skipped, seconds = 0, 0.0
+    with file:
+        for page_num, text in enumerate(texts):
+            if not table_cues.search(text):
+                skipped += 1
+                continue
+            page = file[page_num]
+            start = time.perf_counter()
+            found = page.find_tables()
+            seconds += time.perf_counter() - start
+
+            ts = []
+            for table in found:
+                df = table.to_pandas()
+                if is_expense_header(df.columns):
+                    ts.append((table, df))
+
+            if ts:
+                tbls = []
+                for table, df in ts:
+                    try:
+                        tbls.append(manual_table(df))
+                    except (InvalidTableFormat, ValueError):
+                        tbls.append(crop(page, table.bbox, sha256, crop_dpi))
+                tables.append((page_num, text, tbls))
+
+    return tables, PageScan(len(texts), skipped, seconds)
+
+
+# recognised headers, compared after upper-casing and collapsing whitespace
+header_synonyms = {
+    "CATEGORY": [
+        "CATEGORY",
+        "EXPENSE",
+        "EXPENSES",
+        "EXPENSE CATEGORY",
+        "CATEGORY OF EXPENSE",
+        "DESCRIPTION",
+        "ITEM",
+        "TYPE",
+        "DISBURSEMENT",
+        "DISBURSEMENTS",
+    ],
+    "AMOUNT": [
+        "AMOUNT",
+        "AMOUNT ($)",
+        "TOTAL AMOUNT",
+        "AMOUNT REQUESTED",
+        "AMOUNT INCURRED",
+        "CUMULATIVE AMOUNT",
+    ],
+    "SUB_AMOUNT": ["SUB_AMOUNT", "SUB AMOUNT", "SUBTOTAL", "SUB-TOTAL", "BREAKDOWN"],
+}
+header_targets = {
+    name: target for target, names in header_synonyms.items() for name in names
+}
+# `is_expense_header` needs one of the AMOUNT headers, so pages whose text has none of
+# them, in any case and wrapped over lines, are not worth running find_tables on
+table_cues = re.compile(
+    "|".join(
+        r"(?<!\w)" + r"\s+".join(map(re.escape, name.split())) + r"(?!\w)"
+        for name in sorted(header_synonyms["AMOUNT"], key=len, reverse=True)
+    ),
+    re.IGNORECASE,
+)
+# an amount once "$", "," and spaces are removed
+amount_pattern = r"-?(\d+(\.\d*)?|\.\d+)"
+
+
+def _normalise_header(header) -> str:
+    return re.sub(r"\s+", " ", str(header)).strip().upper()
 
-    return tables
+
+def is_expense_header(columns) -> bool:
+    """Whether a table has an amount column and none of a time sheet."""
+    headers = [_normalise_header(c) for c in columns]
+    return any(header_targets.get(h) == "AMOUNT" for h in headers) and not any(
+        h in ["NARRATIVE", "HOURS"] for h in headers
+    )
+
+
+def map_headers(columns: List[str]) -> Tuple[Dict[str, str], List[str]]:
+    """
+    Maps the columns of a table to CATEGORY, AMOUNT and SUB_AMOUNT, first by name and
+    then by position: the leftmost unnamed column holds the categories, and a single
+    unnamed column between the categories and the amounts holds the breakdown amounts.
+
+    Returns:
+    - Tuple[Dict[str, str], List[str]]: The column mapping and the unmapped columns.
+
+    Raises:
+    - InvalidTableFormat: If no column holds the amounts or the categories.
+    """
+    mapping = {}
+    for column in columns:
+        target = header_targets.get(_normalise_header(column))
+        if target is not None and target not in mapping.values():
+            mapping[column] = target
+    unmapped = [c for c in columns if c not in mapping]
+
+    if "CATEGORY" not in mapping.values() and unmapped and unmapped[0] == columns[0]:
+        mapping[unmapped.pop(0)] = "CATEGORY"
+    if not {"CATEGORY", "AMOUNT"} <= set(mapping.values()):
+        raise InvalidTableFormat
+
+    if "SUB_AMOUNT" not in mapping.values() and len(unmapped) == 1:
+        position = {target: columns.index(c) for c, target in mapping.items()}
+        if position["CATEGORY"] < columns.index(unmapped[0]) < position["AMOUNT"]:
+            mapping[unmapped.pop()] = "SUB_AMOUNT"
+    return mapping, unmapped
+
+
+def _clean_amounts(amounts: pd.DataFrame) -> pd.DataFrame:
+    return (
+        amounts.fillna("")
+        .astype(str)
+        .apply(lambda x: x.str.replace("[$ ,]{1,}", "", regex=True))
+    )
+
+
+def merge_wrapped_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Joins categories wrapped over several rows: a row with a category but no amounts
+    is appended to the row above if it starts in lower case, else prepended to the row below.
+    """
+    categories = (
+        df.CATEGORY.fillna("")
+        .astype(str)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+    no_amounts = (_clean_amounts(df[["AMOUNT", "SUB_AMOUNT"]]) == "").all(axis=1)
+
+    rows, pending = [], ""
+    for category, amount, sub_amount, blank in zip(
+        categories, df.AMOUNT, df.SUB_AMOUNT, no_amounts & (categories != "")
+    ):
+        if blank:
+            if rows and category[:1].islower():
+                rows[-1][0] = f"{rows[-1][0]} {category}"
+            else:
+                pending = f"{pending} {category}".strip()
+            continue
+        rows.append([f"{pending} {category}".strip(), amount, sub_amount])
+        pending = ""
+    if pending:
+        rows.append([pending, "", ""])
+    return pd.DataFrame(rows, columns=["CATEGORY", "AMOUNT", "SUB_AMOUNT"])
 
 
 def manual_table(df):
-    df = df.copy()
-    if len(df.columns) == 3:
-        if not all(df.columns == ["CATEGORY", "Col1", "AMOUNT"]):
-            print(df)
-            raise InvalidTableFormat
-        df.rename(columns={"Col1": "SUB_AMOUNT"}, inplace=True)
-    elif len(df.columns) == 2:
-        if not (
-            all(df.columns == ["CATEGORY", "AMOUNT"])
-            or all(df.columns == ["EXPENSE", "AMOUNT"])
-        ):
-            print(df)
-            raise InvalidTableFormat
+    """
+    Maps a table onto the expense columns without the vision model, see `map_headers`.
+    Amounts are validated here but only converted by `parse_amounts`, for all tables at once.
+
+    Raises:
+    - InvalidTableFormat: If the headers are not recognised, a column is left over with
+      content, or an amount cannot be parsed.
+    """
+    mapping, unmapped = map_headers(list(df.columns))
+    if (df[unmapped].fillna("").astype(str).apply(lambda x: x.str.strip()) != "").any(
+        axis=None
+    ):
+        print(df)
+        raise InvalidTableFormat
+
+    df = df[list(mapping)].rename(columns=mapping)
+    if "SUB_AMOUNT" not in df.columns:
         df["SUB_AMOUNT"] = ""
-        df = df.rename(columns={"EXPENSE": "CATEGORY"})
-    else:
+    df = merge_wrapped_rows(df)
+
+    amounts = _clean_amounts(df[["AMOUNT", "SUB_AMOUNT"]])
+    if not amounts.apply(lambda x: (x == "") | x.str.fullmatch(amount_pattern)).all(
+        axis=None
+    ):
         print(df)
         raise InvalidTableFormat
+    return df
 
-    df[["AMOUNT", "SUB_AMOUNT"]] = df[["AMOUNT", "SUB_AMOUNT"]].apply(
-        lambda x: x.str.replace("[$ ,]{1,}", "", regex=True)
+
+def parse_amounts(frames: List[pd.DataFrame]) -> List[pd.DataFrame]:
+    """
+    Converts the AMOUNT and SUB_AMOUNT columns of the tables returned by `manual_table`
+    to floats, in one vectorised pass over all of them. Empty amounts become 0.
+    """
+    if not frames:
+        return []
+    df = pd.concat(frames, ignore_index=True)
+    df[["AMOUNT", "SUB_AMOUNT"]] = (
+        _clean_amounts(df[["AMOUNT", "SUB_AMOUNT"]])
         .replace("", nan)
         .fillna(0)
         .astype("float")
     )
-    return df
+    bounds = [0, *accumulate(len(frame) for frame in frames)]
+    return [
+        df.iloc[start:end].set_axis(frame.index)
+        for start, end, frame in zip(bounds, bounds[1:], frames)
+    ]
 
 
-def llm_table(page, table):
-    """
-    Parameters:
-    -----------
-    df : pd.DataFrame
-        A DataFrame containing financial or categorical data that needs to be processed.
-        The DataFrame is expected to have either two or three columns:
-        - ["CATEGORY", "AMOUNT"]
-        - ["EXPENSE", "AMOUNT"]
-        - ["CATEGORY", "Col1", "AMOUNT"]
-
-    Returns:
-    --------
-    pd.DataFrame
-        The processed DataFrame with updated column names and cleaned numeric values in
-        the 'AMOUNT' and 'SUB_AMOUNT' columns.
-    """
-    model = ChatOpenAI(model="gpt-4o", api_key=api_key)
+def vision_chain():
+    """The chain reading an `ExpenseTable` from the image of a table."""
+    model = chat_model(model="gpt-4o")
     prompt = ChatPromptTemplate.from_messages(
         [
             ("system", "Output the content of the table provided in the image"),
@@ -171,54 +351,202 @@ def llm_table(page, table):
             ),
         ]
     )
-    chain = prompt | model.with_structured_output(
-        schema=ExpenseTable, include_raw=False
-    )
-    image_data = base64.b64encode(
-        page.get_pixmap(clip=table.bbox, dpi=120).tobytes()
-    ).decode("utf-8")
-    out = chain.invoke(image_data)
-    return pd.DataFrame(out.dict()["rows"])
+    return prompt | model.with_structured_output(schema=ExpenseTable, include_raw=False)
 
 
-expense_docs = pd.read_sql_table("documents", engine)[
-    lambda x: x.title.str.contains("Expense")
-    & (~x.case.isin(pd.read_sql_table("expenses", engine).case))
-]
-
-out = Parallel(-1, verbose=20)(
-    delayed(extract_tables)(doc.case, doc.filename)
-    for i, doc in expense_docs.iterrows()
-)
+async def read_crops(
+    chain, crops: Iterable[str], max_concurrency: int, requests_per_minute: int
+) -> Dict[str, pd.DataFrame]:
+    """
+    Reads table images with the vision model, sharing one `chain` (and client) between
+    at most `max_concurrency` concurrent calls, started at most `requests_per_minute`.
 
-extr = {}
-for case, fname, doc in zip(expense_docs.case, expense_docs.filename, out):
-    if doc:
-        for page in doc:
-            extr[case, fname, page[0]] = page[-1]
+    Parameters:
+    - chain: See `vision_chain`.
+    - crops (Iterable[str]): The image hashes produced by `table_crops.crop`.
+    - max_concurrency (int): Maximum number of calls in flight.
+    - requests_per_minute (int): Maximum rate at which calls are started.
 
-df = (
-    pd.concat(
-        {k: v for k, v in extr.items()}, names=["case", "filename", "page", "idx"]
+    Returns:
+    - Dict[str, pd.DataFrame]: The table read from each image hash. Images whose call failed are left out.
+    """
+    crops = list(dict.fromkeys(crops))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    loop = asyncio.get_running_loop()
+    interval = 60 / requests_per_minute
+    next_start = loop.time()
+
+    async def read(image_hash):
+        nonlocal next_start
+        async with semaphore:
+            start, next_start = next_start, max(loop.time(), next_start) + interval
+            image_data = (await asyncio.to_thread(load_crops, [image_hash]))[image_hash]
+            await asyncio.sleep(start - loop.time())
+            out = await chain.ainvoke(image_data)
+        return pd.DataFrame(out.dict()["rows"])
+
+    results = await asyncio.gather(
+        *(read(crop) for crop in crops), return_exceptions=True
     )
-    .droplevel("idx")
-    .replace("", nan)
-    .dropna(how="all")
-)
+    tables = {}
+    for crop, result in zip(crops, results):
+        if isinstance(result, Exception):
+            print(f"Failed to read a table image: {result!r}")
+        else:
+            tables[crop] = result
+    return tables
 
-assert (
-    df.groupby(df.index)
-    .CATEGORY.agg(lambda x: ((x.str.contains("TOTAL") == True) + x.isna()).sum())
-    .all()
-)
 
-is_total = (df.CATEGORY.str.contains("TOTAL") == True) + df.CATEGORY.isna()
-df.loc[is_total, "CATEGORY"] = "TOTAL"
+if __name__ == "__main__":
+    create_tables()
+    # vision fallback limits
+    max_concurrency = 8
+    requests_per_minute = 300
 
-tx = df[df.CATEGORY != "TOTAL"]
+    expense_docs = pd.read_sql_table("documents", engine)[
+        lambda x: x.title.str.contains("Expense")
+    ]
+    changed = changed_documents(
+        "expenses", zip(expense_docs.case, expense_docs.filename)
+    )
+    expense_docs = expense_docs[
+        ~expense_docs.case.isin(pd.read_sql_table("expenses", engine).case)
+        | pd.Series(
+            list(zip(expense_docs.case, expense_docs.filename)),
+            index=expense_docs.index,
+        ).isin(changed)
+    ]
+
+    # documents whose content was already extracted under another name reuse those rows,
+    # and identical pending documents are only extracted once
+    reused = {}
+    with engine.connect() as conn:
+        for doc in expense_docs.itertuples():
+            if rows := duplicate_rows(conn, expenses_table, doc.case, doc.filename):
+                reused[doc.case, doc.filename] = rows
+    expense_docs = expense_docs[
+        [pair not in reused for pair in zip(expense_docs.case, expense_docs.filename)]
+    ].assign(
+        sha256=lambda x: [
+            blob_hash(case, fname) for case, fname in zip(x.case, x.filename)
+        ]
+    )
+    unique_docs = expense_docs.drop_duplicates("sha256")
+    fill(
+        [
+            f"{data_folder}legal_docs/{case}/{filename}.pdf"
+            for case, filename in zip(unique_docs.case, unique_docs.filename)
+        ]
+    )
 
+    # stage 1: table detection and cropping on all cores
+    out = Parallel(-1, verbose=20)(
+        delayed(extract_tables)(doc.case, doc.filename, doc.sha256)
+        for i, doc in unique_docs.iterrows()
+    )
+    scans = [scan for _, scan in out]
+    out = dict(zip(unique_docs.sha256, [tables for tables, _ in out]))
+
+    scanned = sum(scan.pages - scan.skipped for scan in scans)
+    skipped = sum(scan.skipped for scan in scans)
+    seconds = sum(scan.seconds for scan in scans)
+    print(
+        f"Table detection ran on {scanned} pages and skipped {skipped} "
+        f"of {scanned + skipped} ({seconds:.1f}s spent, "
+        f"~{skipped * seconds / max(scanned, 1):.1f}s saved)"
+    )
 
-tx = tx.reset_index().rename(columns=lambda x: x.lower())
-with engine.connect() as conn:
-    conn.execute(insert(expenses_table).values(tx.to_dict("records")))
-    conn.commit()
+    # stage 2: tables in unknown formats are read by the vision model
+    crops = [
+        table
+        for pages in out.values()
+        if pages
+        for _, _, tables in pages
+        for table in tables
+        if isinstance(table, str)
+    ]
+    manual = [
+        table
+        for pages in out.values()
+        if pages
+        for _, _, tables in pages
+        for table in tables
+        if isinstance(table, pd.DataFrame)
+    ]
+    parsed = dict(zip(map(id, manual), parse_amounts(manual)))
+    print(
+        f"{len(crops)} of {len(crops) + len(manual)} tables "
+        f"({len(crops) / max(len(crops) + len(manual), 1):.1%}) fell back to "
+        f"the vision model, {len(set(crops))} distinct"
+    )
+    read = asyncio.run(
+        read_crops(vision_chain(), crops, max_concurrency, requests_per_minute)
+    )
+
+    # documents with a page that could not be read are left out entirely, keeping their
+    # previous rows, so that the next run extracts them again
+    extr, failed = {}, set()
+    for case, fname, sha256 in zip(
+        expense_docs.case, expense_docs.filename, expense_docs.sha256
+    ):
+        doc = out[sha256]
+        if doc:
+            for page_num, _, tables in doc:
+                tables = [
+                    read.get(t) if isinstance(t, str) else parsed[id(t)] for t in tables
+                ]
+                if any(t is None for t in tables):
+                    print(f"Failed {case} {fname} page {page_num}")
+                    failed.add((case, fname))
+                    continue
+                extr[case, fname, page_num] = pd.concat(tables)
+    extr = {k: v for k, v in extr.items() if k[:2] not in failed}
+
+    # reused rows are saved even when no new tables were extracted
+    values = [row for rows in reused.values() for row in rows]
+    if extr:
+        df = (
+            pd.concat(
+                {k: v for k, v in extr.items()},
+                names=["case", "filename", "page", "idx"],
+            )
+            .droplevel("idx")
+            .replace("", nan)
+            .dropna(how="all")
+        )
+
+        assert (
+            df.groupby(df.index)
+            .CATEGORY.agg(
+                lambda x: ((x.str.contains("TOTAL") == True) + x.isna()).sum()
+            )
+            .all()
+        )
+
+        is_total = (df.CATEGORY.str.contains("TOTAL") == True) + df.CATEGORY.isna()
+        df.loc[is_total, "CATEGORY"] = "TOTAL"
+
+        tx = df[df.CATEGORY != "TOTAL"]
+
+        tx = tx.reset_index().rename(columns=lambda x: x.lower())
+        values = tx.to_dict("records") + values
+    with engine.connect() as conn:
+        conn.execute(
+            delete(expenses_table).where(
+                tuple_(expenses_table.c.case, expenses_table.c.filename).in_(
+                    [pair for pair in changed if pair not in failed]
+                )
+            )
+        )
+        if values:
+            conn.execute(insert(expenses_table).values(values))
+        conn.commit()
+    mark_processed(
+        "expenses",
+        list(reused)
+        + [
+            pair
+            for pair in zip(expense_docs.case, expense_docs.filename)
+            if pair not in failed
+        ],
+    )
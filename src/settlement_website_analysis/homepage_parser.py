@@ -4,14 +4,23 @@ import pandas as pd
 from bs4 import BeautifulSoup
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain_openai import ChatOpenAI
 from sqlalchemy import insert, select
 
-from src.settlement_website_analysis.assets import api_key, data_folder, sites
+from src.settlement_website_analysis.assets import data_folder, load_sites
+from src.settlement_website_analysis.batch_jobs import chat_request, run_job, structured
+from src.settlement_website_analysis.clients import chat_model, limiter_stats
+from src.settlement_website_analysis.compression import compress
+from src.settlement_website_analysis.llm_cache import llm_cache
 from src.settlement_website_analysis.orm import case_table, engine
 
 
 root_dir = data_folder + "legal_docs/"
+# token budget of the homepage text sent to the LLM
+max_prompt_tokens = 6000
+# for backfills: send the homepages as one batch job rather than live calls,
+# through `batch_backend` (None for the OpenAI Batch API, LocalBatches() to test)
+batch_mode = False
+batch_backend = None
 folders = glob("*", root_dir=root_dir)
 
 
@@ -54,10 +63,28 @@ prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-llm = ChatOpenAI(api_key=api_key, temperature=0)
+
+def save_case(conn, company, site, output):
+    print(company, output)
+    _ = conn.execute(
+        insert(case_table).values(
+            case=company,
+            website=site,
+            settlement_date=output.settlement_date,
+            settlement_amount=output.settlement_amount,
+            class_period=output.class_period,
+            allegations=output.allegations,
+        )
+    )
+    conn.commit()
+
+
+llm = chat_model(temperature=0)
 
 runnable = prompt | llm.with_structured_output(schema=SettlementHomePage)
 
+sites = load_sites()
+requests, websites = [], {}
 for company in folders:
     with engine.connect() as conn:
         if conn.execute(select(case_table).where(case_table.c.case == company)).all():
@@ -66,19 +93,24 @@ for company in folders:
         with open(f"{root_dir}{company}/home_page.html", encoding="utf-8") as f:
             soup = BeautifulSoup(f, features="html.parser")
         text = soup.find(class_="content_body").get_text()
-        output = runnable.invoke(text)
-        print(company, output)
-        _ = conn.execute(
-            insert(case_table).values(
-                case=company,
-                website=site,
-                settlement_date=output.settlement_date,
-                settlement_amount=output.settlement_amount,
-                class_period=output.class_period,
-                allegations=output.allegations,
+        text = compress(text, max_tokens=max_prompt_tokens, label=company)
+        if batch_mode:
+            requests.append(
+                chat_request(company, llm, prompt.invoke(text), SettlementHomePage)
             )
-        )
-        conn.commit()
+            websites[company] = site
+            continue
+        output = runnable.invoke(text)
+        save_case(conn, company, site, output)
+
+# failed requests are not saved, so the next run sends them again
+for company, completion in run_job("homepages", requests, batch_backend).items():
+    output = structured(completion, SettlementHomePage)
+    if output is not None:
+        with engine.connect() as conn:
+            save_case(conn, company, websites[company], output)
 
+print(llm_cache.stats())
+print(limiter_stats())
 
 t = pd.read_sql_table("cases", engine)
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Optional, Sequence
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import Generation
+from sqlalchemy import delete, func, insert, select, update
+
+from src.settlement_website_analysis.orm import cache_engine, llm_cache_table
+
+# least recently used responses are evicted once the cache grows beyond this size
+max_cache_bytes = 1 << 30
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+    Persistent cache for every chat model call, stored in the llm_cache table of cache.db.
+
+    Entries are keyed on a hash of LangChain's llm_string (model, temperature and bound
+    arguments such as the structured output schema) and the fully formatted prompt, so
+    editing a prompt template or schema only misses for the calls it affects.
+    """
+
+    def __init__(self, max_bytes: int = max_cache_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\n---\n{prompt}".encode()).hexdigest()
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[Sequence[Generation]]:
+        key = self._key(prompt, llm_string)
+        with cache_engine.connect() as conn:
+            response = conn.execute(
+                select(llm_cache_table.c.response).where(llm_cache_table.c.key == key)
+            ).scalar()
+            if response is None:
+                self._count(hit=False)
+                return None
+            _ = conn.execute(
+                update(llm_cache_table)
+                .where(llm_cache_table.c.key == key)
+                .values(last_used=time.time())
+            )
+            conn.commit()
+        self._count(hit=True)
+        return [loads(gen) for gen in json.loads(response)]
+
+    def update(
+        self, prompt: str, llm_string: str, return_val: Sequence[Generation]
+    ) -> None:
+        response = json.dumps([dumps(gen) for gen in return_val])
+        with cache_engine.connect() as conn:
+            _ = conn.execute(
+                insert(llm_cache_table)
+                .prefix_with("OR REPLACE")
+                .values(
+                    key=self._key(prompt, llm_string),
+                    response=response,
+                    size=len(response),
+                    last_used=time.time(),
+                )
+            )
+            conn.commit()
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute(select(func.sum(llm_cache_table.c.size))).scalar() or 0
+        if total <= self.max_bytes:
+            return
+        # drop the least recently used entries until 10% below the limit
+        excess = total - int(self.max_bytes * 0.9)
+        rows = conn.execute(
+            select(llm_cache_table.c.key, llm_cache_table.c.size).order_by(
+                llm_cache_table.c.last_used
+            )
+        )
+        stale = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            stale.append(key)
+            excess -= size
+        _ = conn.execute(
+            delete(llm_cache_table).where(llm_cache_table.c.key.in_(stale))
+        )
+        conn.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        with cache_engine.connect() as conn:
+            _ = conn.execute(delete(llm_cache_table))
+            conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+llm_cache = SQLiteLLMCache()
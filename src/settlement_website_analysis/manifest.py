@@ -0,0 +1,58 @@
+import os
+import threading
+from datetime import datetime, timezone
+
+import pandas as pd
+
+columns = ["url", "filename", "etag", "last_modified", "sha256", "fetched_at"]
+
+
+class Manifest:
+    """
+    Per-site record of every fetched url, stored as `manifest.csv` in the site folder.
+    Used to send conditional requests on recrawls and to tell new or changed documents apart.
+    """
+
+    def __init__(self, folder) -> None:
+        self.path = f"{folder}/manifest.csv"
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            df = pd.read_csv(self.path, dtype=str, keep_default_na=False)
+            self.entries = {row["url"]: row for row in df.to_dict("records")}
+
+    def headers(self, url, path=None):
+        """
+        Conditional request headers for `url`, or None if it was never fetched
+        (or its local copy at `path` has gone missing).
+        """
+        entry = self.entries.get(url)
+        if entry is None or (path is not None and not os.path.exists(path)):
+            return None
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers or None
+
+    def record(self, url, filename, etag, last_modified, sha256):
+        """
+        Stores a fresh fetch of `url`, returning True if its content is new or changed.
+        """
+        with self._lock:
+            previous = self.entries.get(url)
+            self.entries[url] = {
+                "url": url,
+                "filename": filename,
+                "etag": etag or "",
+                "last_modified": last_modified or "",
+                "sha256": sha256,
+                "fetched_at": datetime.now(timezone.utc).isoformat(),
+            }
+        return previous is None or previous["sha256"] != sha256
+
+    def save(self):
+        with self._lock:
+            df = pd.DataFrame(list(self.entries.values()), columns=columns)
+        df.to_csv(self.path, index=False, encoding="utf-8")
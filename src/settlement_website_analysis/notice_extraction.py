@@ -1,14 +1,45 @@
+import asyncio
+import json
 import pandas as pd
-import fitz
-from src.settlement_website_analysis.orm import documents_table, engine, notice_table
-from sqlalchemy import select, insert
+from src.settlement_website_analysis.orm import (
+    create_tables,
+    documents_table,
+    engine,
+    notice_table,
+)
+from sqlalchemy import delete, insert, select
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_core.pydantic_v1 import BaseModel, Field, create_model
 from langchain_text_splitters import TokenTextSplitter
-from typing import Optional
-from langchain_community.vectorstores import FAISS
-from src.settlement_website_analysis.assets import api_key, data_folder
+from itertools import zip_longest
+from typing import List, Optional
+from src.settlement_website_analysis.assets import data_folder
+from src.settlement_website_analysis.batch_jobs import chat_request, run_job, structured
+from src.settlement_website_analysis.blobs import (
+    blob_hash,
+    changed_documents,
+    duplicate_rows,
+    mark_processed,
+)
+from src.settlement_website_analysis.clients import (
+    chat_model,
+    embeddings,
+    limiter_stats,
+)
+from src.settlement_website_analysis.compression import compress_chunks
+from src.settlement_website_analysis.embedding_store import (
+    EmbeddingStore,
+    StoredEmbeddings,
+)
+from src.settlement_website_analysis.llm_cache import llm_cache
+from src.settlement_website_analysis.page_text import fill, get_pages
+from src.settlement_website_analysis.retrieval import HybridSearch
+from src.settlement_website_analysis.vector_index import (
+    build_index,
+    index_exists,
+    index_key,
+    load_index,
+)
 
 
 class LegalTeam(BaseModel):
@@ -52,6 +83,23 @@ extract_info = {
 }
 
 
+def combined_schema(infos) -> type:
+    """
+    One schema with the fields of every model in `infos`, so that all of them can be
+    extracted by a single structured-output call. Adding a model to `extract_info` (and
+    its column to notice_info) adds it to this call, not another round trip per notice.
+    """
+    fields = {
+        name: (Optional[field.outer_type_], field.field_info)
+        for info in infos
+        for name, field in info.__fields__.items()
+    }
+    return create_model("NoticeInfo", **fields)
+
+
+notice_schema = combined_schema(extract_info)
+
+
 prompt = ChatPromptTemplate.from_messages(
     [
         (
@@ -67,53 +115,312 @@ prompt = ChatPromptTemplate.from_messages(
 
 
 def join_output(docs):
-    chunks = [
-        f"\n\nCHUNK {i}\n" + doc.page_content for i, doc in enumerate(docs, start=1)
-    ]
+    texts = compress_chunks(
+        [doc.page_content for doc in docs], max_tokens=max_prompt_tokens, label="notice"
+    )
+    chunks = [f"\n\nCHUNK {i}\n" + text for i, text in enumerate(texts, start=1)]
     return "".join(chunks)
 
 
-text_splitter = TokenTextSplitter(chunk_size=100, chunk_overlap=50)
-llm = ChatOpenAI(api_key=api_key, temperature=0)
+def merge_chunks(results: List[list]) -> list:
+    """
+    Merges the chunks retrieved for each field, dropping repeats. Chunks are taken
+    by rank across fields, so every field's best chunks come first.
+    """
+    seen, merged = set(), []
+    for docs in zip_longest(*results):
+        for doc in docs:
+            if doc is not None and doc.page_content not in seen:
+                seen.add(doc.page_content)
+                merged.append(doc)
+    return merged
 
-with engine.connect() as conn:
-    docs = conn.execute(
-        select(documents_table).where(
-            documents_table.c.title.contains("NOTICE OF"),
-            documents_table.c.title.contains("PROPOSED SETTLEMENT"),
-            documents_table.c.case.not_in(select(notice_table.c.case)),
-        )
-    )
-    docs = pd.DataFrame(docs.fetchall(), columns=docs.keys())
-    docs["path"] = (
-        data_folder + "legal_docs/" + docs.case + "/" + docs.filename + ".pdf"
-    )
+
+def missing_fields(row: dict) -> list:
+    """The models of `extract_info` with a null value in `row`."""
+    return [
+        info
+        for info in extract_info
+        if any(row.get(name) is None for name in info.__fields__)
+    ]
 
 
-for i, doc in docs.iterrows():
-    f = fitz.open(doc.path)
-    text = "".join([x.get_text() for x in f])
-    chunks = text_splitter.split_text(text)
-    vectorstore = FAISS.from_texts(
-        chunks,
-        embedding=OpenAIEmbeddings(api_key=api_key, model="text-embedding-3-small"),
-    )
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
+def reuse_duplicate(doc) -> bool:
+    """Copies the notice info of an identical, already processed notice, if any."""
+    with engine.connect() as conn:
+        if rows := duplicate_rows(conn, notice_table, doc.case, doc.filename):
+            _ = conn.execute(
+                delete(notice_table).where(notice_table.c.case == doc.case)
+            )
+            _ = conn.execute(insert(notice_table).values(rows))
+            _ = conn.commit()
+        if rows:
+            mark_processed("notice_info", [(doc.case, doc.filename)])
+            return True
+    return False
+
+
+def get_retriever(doc):
+    if use_hybrid:
+        return searches[doc.index_key].as_retriever()
+    vectorstore = load_index(doc.index_key, embedder)
+    if vectorstore is None:
+        vectorstore = build_index(doc.index_key, chunks[doc.index_key], embedder)
+    return vectorstore.as_retriever(search_kwargs={"k": 4})
+
+
+def rag_extractor(info, retriever):
+    runnable = prompt | llm.with_structured_output(schema=info, include_raw=False)
+    return {"text": retriever | join_output} | runnable
+
+
+def combined_extractor():
+    """Extracts `notice_schema` from the merged chunks of all fields."""
+    return prompt | llm.with_structured_output(schema=notice_schema, include_raw=False)
 
+
+def save_row(row, filename):
+    with engine.connect() as conn:
+        _ = conn.execute(delete(notice_table).where(notice_table.c.case == row["case"]))
+        _ = conn.execute(insert(notice_table).values(**row))
+        _ = conn.commit()
+    mark_processed("notice_info", [(row["case"], filename)])
+
+
+def extract_notice(doc):
+    retriever = get_retriever(doc)
     row = {"case": doc.case}
-    for info, rag_prompt in extract_info.items():
-        runnable = prompt | llm.with_structured_output(schema=info, include_raw=False)
-        rag_extractor = {"text": retriever | join_output} | runnable
-        output = rag_extractor.invoke(rag_prompt)
+    pending = extract_info
+    if single_pass:
+        results = retriever.batch(list(extract_info.values()))
+        row |= combined_extractor().invoke({"text": join_output(merge_chunks(results))})
+        print(doc.case, row)
+        pending = missing_fields(row)
+    for info in pending:
+        output = rag_extractor(info, retriever).invoke(extract_info[info])
         row |= output
         print(doc.case, output)
+    save_row(row, doc.filename)
+
+
+async def aextract_notice(doc, semaphore: asyncio.Semaphore):
+    """
+    Runs the extraction chains of all fields of a notice concurrently, holding a slot
+    of the shared `semaphore` per LLM call, and saves the row as soon as it is complete.
+    In `single_pass` mode all fields are first extracted by one call, and only those
+    that come back null get their own chain.
+    """
+    retriever = await asyncio.to_thread(get_retriever, doc)
+
+    async def extract(info, rag_prompt):
+        async with semaphore:
+            return await rag_extractor(info, retriever).ainvoke(rag_prompt)
+
+    row = {"case": doc.case}
+    pending = extract_info
+    if single_pass:
+        results = await retriever.abatch(list(extract_info.values()))
+        async with semaphore:
+            row |= await combined_extractor().ainvoke(
+                {"text": join_output(merge_chunks(results))}
+            )
+        pending = missing_fields(row)
+
+    outputs = await asyncio.gather(
+        *(extract(info, extract_info[info]) for info in pending)
+    )
+    for output in outputs:
+        row |= output
+    print(doc.case, row)
+    save_row(row, doc.filename)
+
+
+async def extract_all(docs, max_concurrency: int):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = await asyncio.gather(
+        *(aextract_notice(doc, semaphore) for doc in docs), return_exceptions=True
+    )
+    for doc, result in zip(docs, results):
+        if isinstance(result, Exception):
+            print(f"Failed {doc.case} {doc.filename}: {result!r}")
+
+
+def extract_batch(docs, backend=None):
+    """
+    Extracts the notice info of `docs` through batch jobs (see `batch_jobs`) instead of
+    live calls: a first job with the combined call of every notice, then a second one
+    with the per-field calls for the fields that came back null. Notices with a failed
+    request are not saved, so that the next run picks them up again.
+    Requests are identified by the JSON encoded (case, filename) of their notice, and
+    a notice listed twice is only sent once.
+    """
+    retrievers, requests = {}, []
+    for doc in docs:
+        key = (doc.case, doc.filename)
+        if key in retrievers:
+            continue
+        retrievers[key] = get_retriever(doc)
+        results = retrievers[key].batch(list(extract_info.values()))
+        text = join_output(merge_chunks(results))
+        requests.append(
+            chat_request(
+                json.dumps(key), llm, prompt.invoke({"text": text}), notice_schema
+            )
+        )
+
+    rows, failed = {}, set()
+    for custom_id, completion in run_job("notices", requests, backend).items():
+        key = tuple(json.loads(custom_id))
+        output = structured(completion, notice_schema)
+        if output is None:
+            failed.add(key)
+        else:
+            rows[key] = {"case": key[0]}
+            rows[key] |= output
+
+    infos = {info.__name__: info for info in extract_info}
+    requests = []
+    for key, row in rows.items():
+        for info in missing_fields(row):
+            text = join_output(retrievers[key].invoke(extract_info[info]))
+            requests.append(
+                chat_request(
+                    json.dumps([*key, info.__name__]),
+                    llm,
+                    prompt.invoke({"text": text}),
+                    info,
+                )
+            )
+    for custom_id, completion in run_job("notice_fields", requests, backend).items():
+        case, filename, name = json.loads(custom_id)
+        output = structured(completion, infos[name])
+        if output is None:
+            failed.add((case, filename))
+        else:
+            rows[case, filename] |= output
+
+    for (case, filename), row in rows.items():
+        if (case, filename) not in failed:
+            print(case, row)
+            save_row(row, filename)
+
+
+chunk_size, chunk_overlap = 100, 50
+embedding_model = "text-embedding-3-small"
+embedding_store = EmbeddingStore(embeddings(model=embedding_model), embedding_model)
+embedder = StoredEmbeddings(embedding_store)
+llm = chat_model(temperature=0)
+# run the field chains of many notices concurrently, with at most
+# `max_concurrency` LLM calls in flight
+use_async = True
+max_concurrency = 8
+# shortlist `shortlist` chunks per field with BM25 and only embed those, rather than
+# embedding every chunk into a FAISS index
+use_hybrid = True
+shortlist = 12
+# extract all fields with one call over the merged chunks, falling back to the
+# per-field chains only for fields that come back null
+single_pass = True
+# token budget of the retrieved chunks sent with each extraction call
+max_prompt_tokens = 1500
+# for backfills: send the extraction calls as batch jobs rather than live calls,
+# through `batch_backend` (None for the OpenAI Batch API, LocalBatches() to test)
+batch_mode = False
+batch_backend = None
+
+if __name__ == "__main__":
+    create_tables()
     with engine.connect() as conn:
-        _ = conn.execute(insert(notice_table).values(**row))
-        _ = conn.commit()
+        docs = conn.execute(
+            select(documents_table).where(
+                documents_table.c.title.contains("NOTICE OF"),
+                documents_table.c.title.contains("PROPOSED SETTLEMENT"),
+            )
+        )
+        docs = pd.DataFrame(docs.fetchall(), columns=docs.keys())
+        done = pd.read_sql(select(notice_table.c.case), conn).case
+    changed = changed_documents("notice_info", zip(docs.case, docs.filename))
+    docs = docs[
+        ~docs.case.isin(done)
+        | pd.Series(list(zip(docs.case, docs.filename)), index=docs.index).isin(changed)
+    ].reset_index(drop=True)
+    # notices that were never stored as a blob have no content to key their index by
+    docs["sha256"] = [
+        blob_hash(case, filename) for case, filename in zip(docs.case, docs.filename)
+    ]
+    for doc in docs[docs.sha256.isna()].itertuples():
+        print(f"No blob for {doc.case} {doc.filename}, skipped")
+    docs = docs[docs.sha256.notna()].reset_index(drop=True)
+    docs["path"] = (
+        data_folder + "legal_docs/" + docs.case + "/" + docs.filename + ".pdf"
+    )
 
-with engine.connect() as conn:
-    pd.read_sql_table("notice_info", conn)
+    text_splitter = TokenTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    docs["index_key"] = [
+        index_key(sha256, embedding_model, chunk_size, chunk_overlap)
+        for sha256 in docs.sha256
+    ]
+    # notices identical to an already processed one are copied, not embedded
+    pending = [doc for _, doc in docs.iterrows() if not reuse_duplicate(doc)]
+    fill([doc.path for doc in pending])
+
+    if use_hybrid:
+        # the vectors of the shortlisted chunks are saved like the full indexes, under a
+        # key that also covers the shortlist and the queries; embed those of every notice
+        # without one, and the queries, in one go
+        searches, unsaved = {}, []
+        for doc in pending:
+            search = HybridSearch(
+                text_splitter.split_text(
+                    "".join(get_pages(doc.path, sha256=doc.sha256))
+                ),
+                embedder,
+                shortlist=shortlist,
+            )
+            searches[doc.index_key] = search
+            key = index_key(doc.index_key, shortlist, *extract_info.values())
+            vectorstore = load_index(key, embedder)
+            if vectorstore is None:
+                unsaved.append((key, search))
+            else:
+                search.use_index(vectorstore)
+        to_embed = [
+            chunk
+            for _, search in unsaved
+            for chunk in search.shortlisted(extract_info.values())
+        ]
+    else:
+        # embed the chunks of every notice without a saved index, and the queries, in one go
+        chunks = {
+            doc.index_key: text_splitter.split_text(
+                "".join(get_pages(doc.path, sha256=doc.sha256))
+            )
+            for doc in pending
+            if not index_exists(doc.index_key)
+        }
+        to_embed = [chunk for doc_chunks in chunks.values() for chunk in doc_chunks]
+    embedding_store.embed_pending(to_embed + list(extract_info.values()))
+    if use_hybrid:
+        for key, search in unsaved:
+            if shortlisted := search.shortlisted(extract_info.values()):
+                search.use_index(build_index(key, shortlisted, embedder))
+
+    if batch_mode:
+        extract_batch(pending, batch_backend)
+    elif use_async:
+        asyncio.run(extract_all(pending, max_concurrency))
+    else:
+        for doc in pending:
+            extract_notice(doc)
 
-with engine.connect() as conn:
-    pd.read_sql_table("cases", conn).to_csv("cases.csv", index=False)
-    pd.read_sql_table("documents", conn).to_csv("documents.csv", index=False)
+    print(llm_cache.stats())
+    print(limiter_stats())
+
+    with engine.connect() as conn:
+        pd.read_sql_table("notice_info", conn)
+
+    with engine.connect() as conn:
+        pd.read_sql_table("cases", conn).to_csv("cases.csv", index=False)
+        pd.read_sql_table("documents", conn).to_csv("documents.csv", index=False)
@@ -1,8 +1,20 @@
-from sqlalchemy import create_engine, Table, Column, String, Float, Integer, MetaData
+from sqlalchemy import (
+    create_engine,
+    Table,
+    Column,
+    String,
+    Float,
+    Integer,
+    LargeBinary,
+    MetaData,
+)
 
 engine = create_engine("sqlite:///data/data.db")
+# derived data that can always be rebuilt from the PDFs, kept out of data.db
+cache_engine = create_engine("sqlite:///data/cache.db")
 
 metadata_obj = MetaData()
+cache_metadata = MetaData()
 
 documents_table = Table(
     "documents",
@@ -53,5 +65,76 @@ summaries_table = Table(
     Column("summary", String),
 )
 
-if __name__ == "__main__":
+blobs_table = Table(
+    "blobs",
+    metadata_obj,
+    Column("case", String),
+    Column("filename", String),
+    Column("sha256", String),
+)
+
+# the content each stage last processed a document at, to tell when it has changed since
+processed_table = Table(
+    "processed",
+    metadata_obj,
+    Column("stage", String, primary_key=True),
+    Column("case", String, primary_key=True),
+    Column("filename", String, primary_key=True),
+    Column("sha256", String),
+)
+
+page_text_table = Table(
+    "page_text",
+    cache_metadata,
+    Column("sha256", String, primary_key=True),
+    Column("clip", String, primary_key=True),
+    Column("page", Integer, primary_key=True),
+    Column("text", String),
+)
+
+llm_cache_table = Table(
+    "llm_cache",
+    cache_metadata,
+    Column("key", String, primary_key=True),
+    Column("response", String),
+    Column("size", Integer),
+    Column("last_used", Float),
+)
+
+embeddings_table = Table(
+    "embeddings",
+    cache_metadata,
+    Column("model", String, primary_key=True),
+    Column("text_hash", String, primary_key=True),
+    Column("row", Integer),
+)
+
+table_crops_table = Table(
+    "table_crops",
+    cache_metadata,
+    Column("sha256", String, primary_key=True),
+    Column("page", Integer, primary_key=True),
+    Column("bbox", String, primary_key=True),
+    Column("dpi", Integer, primary_key=True),
+    Column("image_hash", String),
+)
+
+crop_images_table = Table(
+    "crop_images",
+    cache_metadata,
+    Column("image_hash", String, primary_key=True),
+    Column("image", LargeBinary),
+)
+
+
+def create_tables():
+    """
+    Creates the tables missing from data.db and cache.db, e.g. those added since the
+    databases were created. Existing tables are left untouched.
+    """
     metadata_obj.create_all(engine)
+    cache_metadata.create_all(cache_engine)
+
+
+if __name__ == "__main__":
+    create_tables()
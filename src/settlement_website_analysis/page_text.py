@@ -0,0 +1,112 @@
+from typing import Iterator, List, Optional, Tuple
+
+import fitz
+from joblib import Parallel, delayed
+from sqlalchemy import insert, select
+
+from src.settlement_website_analysis.blobs import file_hash
+from src.settlement_website_analysis.orm import cache_engine, page_text_table
+
+# page body without running headers and footers, as used to split filings into exhibits;
+# None stands for the right edge of the first page
+BODY_CLIP = (0, 40, None, 734)
+
+
+def _clip_key(clip: Optional[Tuple]) -> str:
+    if clip is None:
+        return ""
+    return ",".join("" if x is None else str(x) for x in clip)
+
+
+def _clip_rect(clip: Optional[Tuple], file: fitz.Document) -> Optional[fitz.Rect]:
+    if clip is None:
+        return None
+    defaults = file[0].rect
+    return fitz.Rect(*(d if x is None else x for x, d in zip(clip, defaults)))
+
+
+def _cached(sha256: str, key: str) -> List[str]:
+    with cache_engine.connect() as conn:
+        rows = conn.execute(
+            select(page_text_table.c.text)
+            .where(page_text_table.c.sha256 == sha256, page_text_table.c.clip == key)
+            .order_by(page_text_table.c.page)
+        )
+        return [text for (text,) in rows]
+
+
+def _save(sha256: str, key: str, texts: List[str]):
+    if not texts:
+        return
+    with cache_engine.connect() as conn:
+        _ = conn.execute(
+            insert(page_text_table)
+            .prefix_with("OR IGNORE")
+            .values(
+                [
+                    {"sha256": sha256, "clip": key, "page": i, "text": text}
+                    for i, text in enumerate(texts)
+                ]
+            )
+        )
+        conn.commit()
+
+
+def iter_pages(
+    path: str, clip: Optional[Tuple] = None, sha256: Optional[str] = None
+) -> Iterator[str]:
+    """
+    Yields the text of each page of a PDF, parsing it with PyMuPDF only if the
+    (file hash, clip) pair is not cached yet. Pages are yielded as they are parsed.
+
+    Parameters:
+    - path (str): The PDF file.
+    - clip (Tuple): Optional (x0, y0, x1, y1) area to restrict the text to, see BODY_CLIP.
+    - sha256 (str): The hash of the PDF if already known, which saves reading the
+      whole file to compute it, see `blobs.file_hash`.
+
+    Returns:
+    - Iterator[str]: The text of each page.
+    """
+    sha256, key = sha256 or file_hash(path), _clip_key(clip)
+    texts = _cached(sha256, key)
+    if texts:
+        yield from texts
+        return
+
+    with fitz.open(path) as file:
+        rect = _clip_rect(clip, file)
+        for page in file:
+            texts.append(page.get_text(clip=rect))
+            yield texts[-1]
+    _save(sha256, key, texts)
+
+
+def get_pages(
+    path: str, clip: Optional[Tuple] = None, sha256: Optional[str] = None
+) -> List[str]:
+    return list(iter_pages(path, clip, sha256))
+
+
+def _parse(path: str, clip: Optional[Tuple]):
+    key = _clip_key(clip)
+    try:
+        sha256 = file_hash(path)
+        if _cached(sha256, key):
+            return None
+        with fitz.open(path) as file:
+            rect = _clip_rect(clip, file)
+            return sha256, key, [page.get_text(clip=rect) for page in file]
+    except (fitz.FileDataError, fitz.FileNotFoundError, IndexError, OSError):
+        return None
+
+
+def fill(paths: List[str], clip: Optional[Tuple] = None, n_jobs: int = -1):
+    """
+    Parses every not yet cached PDF in parallel and stores its page texts,
+    so that later `iter_pages` / `get_pages` calls never open the files.
+    """
+    results = Parallel(n_jobs)(delayed(_parse)(path, clip) for path in set(paths))
+    for result in results:
+        if result is not None:
+            _save(*result)
@@ -0,0 +1,254 @@
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+
+# responses retried by the transports, with exponential backoff unless Retry-After says otherwise
+retry_statuses = {429, 500, 502, 503, 504}
+max_retries = 5
+backoff_factor = 1.0
+# responses slower than this shrink the concurrency like a (milder) 429 would
+slow_latency = 60.0
+
+
+class RateLimiter:
+    """
+    Token bucket for requests and tokens per minute, plus an AIMD limit on the calls in
+    flight: each success raises it by 1 / limit, up to `max_concurrency`, while a 429
+    halves it and holds every call until the server's Retry-After.
+
+    The state lives in this process and is shared by its threads (`acquire`) and
+    coroutines (`aacquire`), under a lock only held for bookkeeping, never while waiting.
+    Pipelines running side by side should split the API's limits between them.
+
+    Parameters:
+    - name (str): The bucket, e.g. one per API and model family.
+    - requests_per_minute (int): Sustained request rate, also the burst size.
+    - tokens_per_minute (int): Sustained token rate, also the burst size.
+    - max_concurrency (int): Most calls in flight.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        max_concurrency: int = 16,
+    ) -> None:
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._condition = threading.Condition()
+        # futures of the coroutines waiting in `aacquire`, with their event loops
+        self._waiters = []
+
+    def _take(self, tokens: int) -> Optional[float]:
+        """
+        Takes a slot, one request and `tokens` from the bucket, returning 0.0, or else
+        how long until the bucket allows it, or None while every slot is taken.
+        Called with the lock held.
+        """
+        if self.in_flight >= int(self.concurrency):
+            return None
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        self.requests = min(
+            self.requests_per_minute,
+            self.requests + elapsed * self.requests_per_minute / 60,
+        )
+        self.tokens = min(
+            self.tokens_per_minute,
+            self.tokens + elapsed * self.tokens_per_minute / 60,
+        )
+        wait = max(
+            self.blocked_until - now,
+            (1 - self.requests) * 60 / self.requests_per_minute,
+            (tokens - self.tokens) * 60 / self.tokens_per_minute,
+        )
+        if wait > 0:
+            return wait
+        self.requests -= 1
+        self.tokens -= tokens
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self, tokens: int):
+        """Blocks until a call of about `tokens` tokens may be sent."""
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._condition:
+            while (wait := self._take(tokens)) != 0.0:
+                self._condition.wait(wait)
+
+    async def aacquire(self, tokens: int):
+        """Like `acquire`, waiting on the event loop rather than blocking it."""
+        tokens = min(tokens, self.tokens_per_minute)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                wait = self._take(tokens)
+                if wait == 0.0:
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                # woken early by `release`, which may have freed a slot or set a block
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+
+    def release(self, status_code: int, latency: float, retry_after: float = None):
+        """Reports how a call went, adapting the concurrency limit."""
+        with self._condition:
+            self.in_flight -= 1
+            if status_code == 429:
+                self.throttled += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+            elif latency > slow_latency:
+                self.concurrency = max(1.0, self.concurrency - 1)
+            elif status_code is not None and status_code < 400:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+            if retry_after:
+                self.blocked_until = max(
+                    self.blocked_until, time.monotonic() + retry_after
+                )
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # the loop of that waiter was closed
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "concurrency": round(self.concurrency, 1),
+            "throttled": self.throttled,
+        }
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def estimate_tokens(request: httpx.Request) -> int:
+    """Rough token cost of an OpenAI request: about 4 bytes per token, plus the completion."""
+    body = request.content
+    tokens = len(body) // 4
+    if b'"max_tokens"' in body or b'"max_completion_tokens"' in body:
+        return tokens + 1000
+    return tokens + (256 if b'"messages"' in body else 0)
+
+
+def retry_delay(response: httpx.Response, attempt: int) -> float:
+    header = response.headers.get("retry-after")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return backoff_factor * 2**attempt
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """httpx transport sending every request through a `RateLimiter`, retrying 429s and 5xx."""
+
+    def __init__(self, limiter: RateLimiter, transport: httpx.BaseTransport = None):
+        self.limiter = limiter
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        tokens = estimate_tokens(request)
+        for attempt in range(max_retries + 1):
+            self.limiter.acquire(tokens)
+            start = time.monotonic()
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError:
+                self.limiter.release(None, time.monotonic() - start)
+                if attempt == max_retries:
+                    raise
+                time.sleep(backoff_factor * 2**attempt)
+                continue
+            except BaseException:
+                self.limiter.release(None, time.monotonic() - start)
+                raise
+
+            status, delay = response.status_code, None
+            if status in retry_statuses:
+                delay = retry_delay(response, attempt)
+            self.limiter.release(
+                status, time.monotonic() - start, delay if status == 429 else None
+            )
+            if delay is None or attempt == max_retries:
+                return response
+            response.close()
+            time.sleep(delay)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """The asyncio counterpart of `RateLimitedTransport`, sharing the same limiter."""
+
+    def __init__(
+        self, limiter: RateLimiter, transport: httpx.AsyncBaseTransport = None
+    ):
+        self.limiter = limiter
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        tokens = estimate_tokens(request)
+        for attempt in range(max_retries + 1):
+            await self.limiter.aacquire(tokens)
+            start = time.monotonic()
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError:
+                self.limiter.release(None, time.monotonic() - start)
+                if attempt == max_retries:
+                    raise
+                await asyncio.sleep(backoff_factor * 2**attempt)
+                continue
+            except BaseException:
+                self.limiter.release(None, time.monotonic() - start)
+                raise
+
+            status, delay = response.status_code, None
+            if status in retry_statuses:
+                delay = retry_delay(response, attempt)
+            self.limiter.release(
+                status, time.monotonic() - start, delay if status == 429 else None
+            )
+            if delay is None or attempt == max_retries:
+                return response
+            await response.aclose()
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self.transport.aclose()
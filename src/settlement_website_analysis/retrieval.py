@@ -0,0 +1,112 @@
+import math
+import re
+from collections import Counter
+from typing import Iterable, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+
+token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return token_pattern.findall(text.lower())
+
+
+class BM25:
+    """Okapi BM25 over a small corpus, e.g. the chunks of one document."""
+
+    def __init__(self, corpus: List[str], k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1, self.b = k1, b
+        self.docs = [Counter(tokenize(text)) for text in corpus]
+        self.lengths = np.array([sum(doc.values()) for doc in self.docs], dtype=float)
+        self.avg_length = self.lengths.mean() if len(self.docs) else 0.0
+        frequencies = Counter(term for doc in self.docs for term in doc)
+        n = len(self.docs)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in frequencies.items()
+        }
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.docs))
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / (self.avg_length or 1))
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            tf = np.array([doc[term] for doc in self.docs], dtype=float)
+            scores += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def top(self, query: str, n: int) -> List[int]:
+        """Indices of the `n` best scoring documents, best first."""
+        return list(np.argsort(-self.scores(query), kind="stable")[:n])
+
+
+class HybridSearch:
+    """
+    Two-stage retrieval over the chunks of a document: BM25 shortlists `shortlist`
+    candidates per query, and only those are embedded and reranked by cosine similarity.
+    The vectors can be read from a saved index of the shortlisted chunks instead, see
+    `use_index`.
+
+    Parameters:
+    - chunks (List[str]): The chunks of the document.
+    - embedding (Embeddings): The model used to embed the candidates and the queries.
+    - shortlist (int): Number of lexical candidates per query.
+    - k (int): Number of chunks returned per query.
+    """
+
+    def __init__(
+        self, chunks: List[str], embedding: Embeddings, shortlist: int = 12, k: int = 4
+    ) -> None:
+        self.chunks = chunks
+        self.embedding = embedding
+        self.shortlist = shortlist
+        self.k = k
+        self.bm25 = BM25(chunks)
+        self.index, self.positions = None, {}
+
+    def use_index(self, vectorstore) -> None:
+        """
+        Reads the vectors of the chunks in `vectorstore`, e.g. a FAISS index of the
+        shortlisted chunks saved with `vector_index.build_index`, rather than embedding
+        them at search time. Chunks missing from it are still embedded.
+        """
+        self.index = vectorstore.index
+        self.positions = {
+            vectorstore.docstore.search(doc_id).page_content: position
+            for position, doc_id in vectorstore.index_to_docstore_id.items()
+        }
+
+    def candidates(self, query: str) -> List[int]:
+        return self.bm25.top(query, self.shortlist)
+
+    def shortlisted(self, queries: Iterable[str]) -> List[str]:
+        """The chunks shortlisted for any of `queries`, i.e. all that will be embedded."""
+        indices = sorted({i for query in queries for i in self.candidates(query)})
+        return [self.chunks[i] for i in indices]
+
+    def search(self, query: str) -> List[Document]:
+        indices = self.candidates(query)
+        if not indices:
+            return []
+        texts = [self.chunks[i] for i in indices]
+        if all(text in self.positions for text in texts):
+            vectors = np.array(
+                [self.index.reconstruct(int(self.positions[text])) for text in texts]
+            )
+        else:
+            vectors = np.array(self.embedding.embed_documents(texts))
+        query_vector = np.array(self.embedding.embed_query(query))
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+        similarity = vectors @ query_vector / np.maximum(norms, 1e-12)
+        best = np.argsort(-similarity, kind="stable")[: self.k]
+        return [Document(self.chunks[indices[i]]) for i in best]
+
+    def as_retriever(self) -> RunnableLambda:
+        """A runnable mapping a query to its documents, like `VectorStore.as_retriever`."""
+        return RunnableLambda(self.search)
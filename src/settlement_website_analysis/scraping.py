@@ -1,37 +1,63 @@
+import hashlib
 import pandas as pd
+import requests
 from bs4 import BeautifulSoup
 import os
+from functools import partial
 from urllib.parse import urljoin
 from shutil import rmtree
 from random import shuffle
-from src.settlement_website_analysis.assets import sites, RequestError, get, Website
-
-
-def epiq(site):
-    current_page = urljoin(site.url, "Home/Documents")
-    response = get(current_page)
-    soup = BeautifulSoup(response.text)
-    docs = soup.find(id="Documents")
+from src.settlement_website_analysis.assets import (
+    load_sites,
+    RequestError,
+    get,
+    download,
+    pool_map,
+    Website,
+)
+from src.settlement_website_analysis.blobs import store
+from src.settlement_website_analysis.manifest import Manifest
+from src.settlement_website_analysis.orm import create_tables
+
+
+def epiq(site, recrawl=False):
     folder = "data/legal_docs/" + site.name
-    if os.path.exists(folder):
-        return
-    os.mkdir(folder)
+    existed = os.path.exists(folder)
+    if existed and not recrawl:
+        return []
+    manifest = Manifest(folder)
     try:
-        save_all(docs, folder, site)
-    except RequestError as e:
-        with open(folder + "/" + "failed.txt", "a") as f:
-            f.write(f"{e.status_code},{e.url}\n")
-        print(f"{e.status_code}: {e.url}")
-    except:
-        rmtree(folder)
-
-
-def gilardi(site):
-    gilardi_page(site)
-    gilardi_docs(site)
+        soup = fetch_docs_page(site, urljoin(site.url, "Home/Documents"), manifest)
+    except (RequestError, requests.RequestException) as e:
+        # nothing was saved, the site is tried again on the next crawl
+        print(f"{site.url}: {e}")
+        return []
+    docs = soup.find(id="Documents")
+    try:
+        return save_all(docs, folder, site, manifest)
+    except Exception as e:
+        print(f"{site.url}: {e!r}")
+        if not existed:
+            rmtree(folder)
+    finally:
+        if os.path.exists(folder):
+            manifest.save()
+    return []
+
+
+def gilardi(site, recrawl=False):
+    manifest = Manifest("data/legal_docs/" + site.name)
+    try:
+        gilardi_page(site, manifest, recrawl)
+    except (RequestError, requests.RequestException) as e:
+        print(f"{site.url}: {e}")
+        return []
+    changed = gilardi_docs(site, manifest, recrawl)
+    manifest.save()
+    return changed
 
 
-def gilardi_docs(site):
+def gilardi_docs(site, manifest, recrawl=False):
     folder = "data/legal_docs/" + site.name
 
     with open(f"{folder}/docs_page.html", "rt", encoding="utf-8") as f:
@@ -53,15 +79,40 @@ def gilardi_docs(site):
 
     df.to_csv(f"{folder}/index.csv", index=False, encoding="utf-8")
 
-    for i, row in df.iterrows():
+    def fetch(row):
         path = f"{folder}/{row.filename}.pdf"
-        if not os.path.exists(path):
+        if recrawl or not os.path.exists(path):
             try:
-                response = get(row.link)
-                with open(path, "wb") as file:
-                    file.write(response.content)
-            except RequestError as e:
-                print(e)
+                return fetch_document(
+                    manifest, row.link, path, site.name, str(row.filename)
+                )
+            except (RequestError, requests.RequestException) as e:
+                return e
+
+    changed = pool_map(fetch, (row for _, row in df.iterrows()))
+    record_failures(
+        folder,
+        [(link, e) for link, e in zip(df.link, changed) if isinstance(e, Exception)],
+    )
+    return [str(fname) for fname, new in zip(df.filename, changed) if new is True]
+
+
+def record_failures(folder, failures):
+    """
+    Appends failed downloads to the `failed.txt` of a site, as `<status>,<url>` lines.
+
+    Parameters:
+    - folder (str): The site folder.
+    - failures (list): (url, exception) pairs; the status is the HTTP status code of a
+      RequestError, or the exception name for timeouts and connection errors.
+    """
+    if not failures:
+        return
+    with open(folder + "/" + "failed.txt", "a") as f:
+        for url, e in failures:
+            status = getattr(e, "status_code", type(e).__name__)
+            f.write(f"{status},{url}\n")
+            print(f"{status}: {url}")
 
 
 def maybe_write(path, text):
@@ -70,47 +121,131 @@ def maybe_write(path, text):
             f.write(text)
 
 
-def gilardi_page(site):
+def gilardi_page(site, manifest, recrawl=False):
     folder = "data/legal_docs/" + site.name
 
     current_page = urljoin(site.url, "case-documents.aspx")
-    response = get(current_page)
-    site.docs_page = response.text
+    if recrawl or not os.path.exists(f"{folder}/docs_page.html"):
+        fetch_docs_page(site, current_page, manifest)
 
     if not os.path.exists(folder):
         os.mkdir(folder)
     maybe_write(f"{folder}/home_page.html", site.home_page)
-    maybe_write(f"{folder}/docs_page.html", site.docs_page)
 
 
-def save_all(docs, folder, site, prefix="", data=None):
-    if not data:
+def fetch_docs_page(site, url, manifest):
+    """
+    Conditionally fetches the documents page of a site and saves it as `docs_page.html`.
+
+    Returns:
+    - BeautifulSoup: The parsed page (read back from disk if unchanged since the last crawl).
+    """
+    folder = "data/legal_docs/" + site.name
+    path = f"{folder}/docs_page.html"
+    response = get(url, headers=manifest.headers(url, path))
+    if response.status_code == 304:
+        with open(path, "rt", encoding="utf-8") as f:
+            site.docs_page = f.read()
+    else:
+        site.docs_page = response.text
+        os.makedirs(folder, exist_ok=True)
+        with open(path, "wt", encoding="utf-8") as f:
+            f.write(site.docs_page)
+        manifest.record(
+            url,
+            "docs_page.html",
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            hashlib.sha256(response.content).hexdigest(),
+        )
+    return BeautifulSoup(site.docs_page)
+
+
+def fetch_document(manifest, url, path, case, filename):
+    """
+    Downloads a document unless the server reports it unchanged since the last crawl,
+    and adds it to the content-addressed blob store.
+
+    Returns:
+    - bool: True if the document is new or its content changed.
+    """
+    result = download(url, path, headers=manifest.headers(url, path))
+    if result is None:
+        return False
+    store(path, case, filename, result.sha256)
+    return manifest.record(
+        url, filename, result.etag, result.last_modified, result.sha256
+    )
+
+
+def list_documents(docs, site, prefix="", data=None):
+    """
+    Walks the nested <ul> of an Epiq documents page, returning (filename, full_name, link) dicts.
+    """
+    if data is None:
         data = []
     lvl = list(enumerate(docs.ul.find_all("li", recursive=False), start=1))
-    shuffle(lvl)
     for counter, item in lvl:
-        response = get(urljoin(site.url, item.a.get("href")))
         fname = f"{prefix}{counter}."
-        path = f"{folder}/{fname}.pdf"
-        with open(path, "wb") as file:
-            file.write(response.content)
-
         if item.ul is not None:
-            save_all(item, folder, site, prefix=fname, data=data)
-        data.append({"filename": fname, "full_name": item.a.text})
-    pd.DataFrame(data).to_csv(f"{folder}/index.csv", index=False)
+            list_documents(item, site, prefix=fname, data=data)
+        data.append(
+            {
+                "filename": fname,
+                "full_name": item.a.text,
+                "link": urljoin(site.url, item.a.get("href")),
+            }
+        )
+    return data
+
+
+def save_all(docs, folder, site, manifest):
+    data = list_documents(docs, site)
+    jobs = list(data)
+    shuffle(jobs)
+
+    def fetch(doc):
+        path = f"{folder}/{doc['filename']}.pdf"
+        try:
+            return fetch_document(
+                manifest, doc["link"], path, site.name, doc["filename"]
+            )
+        except (RequestError, requests.RequestException) as e:
+            return e
+
+    results = pool_map(fetch, jobs)
+    pd.DataFrame(data).drop(columns="link").to_csv(f"{folder}/index.csv", index=False)
+    record_failures(
+        folder,
+        [(doc["link"], e) for doc, e in zip(jobs, results) if isinstance(e, Exception)],
+    )
+    return [doc["filename"] for doc, new in zip(jobs, results) if new is True]
 
 
-for idx, site in sites[sites.Company == "Airbus"].iterrows():
-    site = Website(site.Website, site.Company)
+def process_site(row, recrawl=False):
+    site = Website(row.Website, row.Company)
 
     try:
         response = get(site.url)
     except:
         print(site.url)
-        continue
+        return []
     site.home_page = response.text
 
     if "www.gilardi.com" in response.text:
-        gilardi(site)
+        changed = gilardi(site, recrawl)
         print(site.name)
+        return [(site.name, fname) for fname in changed]
+    return []
+
+
+if __name__ == "__main__":
+    recrawl = False
+    create_tables()
+    sites = load_sites()
+    changes = pool_map(
+        partial(process_site, recrawl=recrawl),
+        (row for _, row in sites[sites.Company == "Airbus"].iterrows()),
+    )
+    # the stages tell changed documents from their blob hash, see `blobs.changed_documents`
+    print(f"{sum(map(len, changes))} new or changed documents")
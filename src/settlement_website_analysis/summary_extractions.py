@@ -1,8 +1,15 @@
+import json
+import multiprocessing
+import os
+import queue
 import re
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pprint import pprint
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-import fitz
 import nltk
 import pandas as pd
 import spacy
@@ -10,14 +17,39 @@ from langchain_community.document_transformers.embeddings_redundant_filter impor
     EmbeddingsClusteringFilter,
 )
 from langchain_core.documents import Document
+from langchain_core.prompt_values import PromptValue
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from nltk.corpus import words
-from sqlalchemy import insert, select
+from sqlalchemy import delete, insert, select
+
+from src.settlement_website_analysis.assets import data_folder
+from src.settlement_website_analysis.batch_jobs import chat_request, content, run_job
+from src.settlement_website_analysis.blobs import (
+    changed_documents,
+    duplicate_rows,
+    mark_processed,
+)
+from src.settlement_website_analysis.clients import (
+    chat_model,
+    embeddings,
+    limiter_stats,
+)
+from src.settlement_website_analysis.embedding_store import (
+    EmbeddingStore,
+    StoredEmbeddings,
+)
+from src.settlement_website_analysis.llm_cache import llm_cache
+from src.settlement_website_analysis.orm import (
+    cache_engine,
+    create_tables,
+    engine,
+    summaries_table,
+)
+from src.settlement_website_analysis.page_text import BODY_CLIP, fill, iter_pages
 
-from src.settlement_website_analysis.assets import api_key, data_folder
-from src.settlement_website_analysis.orm import engine, summaries_table
+# NLTK `words` corpus, one word per line, built on first use
+word_list_path = data_folder + "english_words.txt"
 
 
 # A class representing the document summary structure
@@ -34,10 +66,32 @@ class DocumentSummary(BaseModel):
 
 # A class to recognize English language text using NLTK
 class EnglishRecognizer:
-    def __init__(self) -> None:
-        nltk.download("words", quiet=True)
-        nltk.download("punkt", quiet=True)
-        self.word_list = set(words.words())
+    # word-like runs and single punctuation marks, a cheap stand-in for nltk.word_tokenize
+    token_pattern = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, word_list_path: str = word_list_path) -> None:
+        """
+        Loads the English word list from `word_list_path`, building that file
+        from the NLTK corpus (downloading it if needed) only on the first run.
+        """
+        if not os.path.exists(word_list_path):
+            nltk.download("words", quiet=True)
+            word_list = sorted(set(words.words()))
+            # written next to the final path and renamed into place, so that process
+            # pool workers starting together never read a partly written list
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(word_list_path) or ".", suffix=".part"
+            )
+            try:
+                with os.fdopen(fd, "wt", encoding="utf-8") as f:
+                    f.write("\n".join(word_list))
+                os.replace(tmp_path, word_list_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        with open(word_list_path, encoding="utf-8") as f:
+            self.word_list = set(f.read().split("\n"))
+        self._punkt_ready = False
 
     def is_english(self, text: str, threshold: float = 0.5) -> bool:
         """
@@ -50,12 +104,61 @@ class EnglishRecognizer:
         Returns:
         - bool: True if the text is mostly in English, False otherwise.
         """
+        if not self._punkt_ready:
+            nltk.download("punkt", quiet=True)
+            self._punkt_ready = True
         tokens = nltk.word_tokenize(text)
         if len(tokens) == 0:
             return False
         english_words = [word for word in tokens if word.lower() in self.word_list]
         return len(english_words) / len(tokens) > threshold
 
+    def is_english_sampled(
+        self,
+        text: str,
+        threshold: float = 0.5,
+        n_samples: int = 8,
+        sample_chars: int = 2000,
+        min_tokens: int = 200,
+        margin: float = 0.05,
+    ) -> bool:
+        """
+        Approximate `is_english` that only reads up to `n_samples` windows of
+        `sample_chars` characters spread evenly over the text, tokenized with a regex.
+        Stops early once at least `min_tokens` tokens were seen and the English fraction
+        is more than `margin` away from `threshold`.
+
+        Parameters:
+        - text (str): The input text to evaluate.
+        - threshold (float): The minimum fraction of words that must be English.
+        - n_samples (int): Maximum number of windows to read.
+        - sample_chars (int): Size of each window.
+        - min_tokens (int): Tokens to see before an early decision.
+        - margin (float): Distance from the threshold that counts as clearly met or missed.
+
+        Returns:
+        - bool: True if the text is mostly in English, False otherwise.
+        """
+        if len(text) <= n_samples * sample_chars:
+            starts = range(0, len(text), sample_chars)
+        else:
+            step = (len(text) - sample_chars) / (n_samples - 1)
+            starts = [round(i * step) for i in range(n_samples)]
+
+        n_tokens = n_english = 0
+        for start in starts:
+            tokens = self.token_pattern.findall(text, start, start + sample_chars)
+            n_tokens += len(tokens)
+            n_english += sum(token.lower() in self.word_list for token in tokens)
+            if (
+                n_tokens >= min_tokens
+                and abs(n_english / n_tokens - threshold) > margin
+            ):
+                break
+        if n_tokens == 0:
+            return False
+        return n_english / n_tokens > threshold
+
 
 def further_split(sent: str, maxlen: int) -> List[str]:
     """
@@ -101,135 +204,343 @@ def make_chunks(t: str, nlp: spacy.Language, maxlen: int = 1000) -> List[str]:
     return chunks
 
 
-def split_docs(file: fitz.Document) -> List[str]:
+def load_chunker(rule_based: bool = False) -> spacy.Language:
     """
-    Splits a PDF document into smaller sub-documents based on some heuristic.
+    Loads a spaCy pipeline that only does sentence segmentation.
 
     Parameters:
-    - file: A PyMuPDF file object.
+    - rule_based (bool): Use the punctuation-based sentencizer instead of the parser.
+      Much faster, but its sentence boundaries (and so the chunks) differ slightly.
 
     Returns:
-    - List[str]: List of sub-document text chunks.
-    """
-    sections = [""]
-    titles = ["main"]
-    for page in f:
-        t = (
-            page.get_text(clip=fitz.Rect(0, 40, f[0].rect[-2], 734))
-            .replace("\n", " ")
-            .strip()
-            .replace("  ", " ")
+    - spacy.Language: en_core_web_sm without tagger, lemmatizer and NER, whose
+      parser yields the same sentences as the full pipeline; or the sentencizer.
+    """
+    if rule_based:
+        nlp = spacy.blank("en")
+        nlp.add_pipe("sentencizer")
+        return nlp
+    return spacy.load(
+        "en_core_web_sm", exclude=["tagger", "attribute_ruler", "lemmatizer", "ner"]
+    )
+
+
+def pack_chunks(pieces: Iterable[str], maxlen: int) -> List[str]:
+    """
+    Greedily joins pieces into chunks shorter than `maxlen`, like `make_chunks`,
+    but tracking lengths and joining each chunk once instead of concatenating repeatedly.
+    """
+    chunks = []
+    current, length = [], 0
+    for piece in pieces:
+        if length + len(piece) < maxlen:
+            current.append(piece)
+            length += len(piece)
+        else:
+            chunks.append("".join(current))
+            current, length = [piece], len(piece)
+    chunks.append("".join(current))
+    return chunks
+
+
+def make_chunks_fast(
+    texts: List[str], nlp: spacy.Language, maxlen: int = 1000, batch_size: int = 4
+) -> List[List[str]]:
+    """
+    Linear-time `make_chunks` over many texts, batched through `nlp.pipe`.
+    With `load_chunker()` the output is identical to `make_chunks` with the full model.
+
+    Parameters:
+    - texts (List[str]): The input texts.
+    - nlp: A SpaCy language model instance, ideally from `load_chunker`.
+    - maxlen (int): The maximum length of each chunk.
+    - batch_size (int): Number of texts processed together by spaCy.
+
+    Returns:
+    - List[List[str]]: The chunks of each text.
+    """
+    return [
+        pack_chunks(
+            (sub for sent in doc.sents for sub in further_split(sent.text, maxlen)),
+            maxlen,
         )
+        for doc in nlp.pipe(texts, batch_size=batch_size)
+    ]
+
+
+def iter_subdocuments(pages: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Splits a PDF document into smaller sub-documents based on some heuristic,
+    yielding each one as soon as the next `EXHIBIT X` page (or the end) is reached.
+    Pages are consumed lazily, so only the current section is held in memory.
+
+    Parameters:
+    - pages: The text of each page, clipped to BODY_CLIP (see `page_text.iter_pages`).
+
+    Returns:
+    - Iterator[Tuple[str, str]]: (title, text) of each sub-document, starting with "main".
+    """
+    title, parts = "main", []
+    for page in pages:
+        t = page.replace("\n", " ").strip().replace("  ", " ")
         if re.match(r"^EXHIBIT [^\s]{1,3}$", t):
-            sections.append("")
-            titles.append(t)
+            yield title, "".join(parts)
+            title, parts = t, []
         else:
-            sections[-1] += r"\n" + t
+            parts.append(r"\n" + t)
+    yield title, "".join(parts)
 
-    return dict(zip(titles, sections))
 
+def split_docs(pages: Iterable[str]) -> Dict[str, str]:
+    """
+    Splits a PDF document into smaller sub-documents based on some heuristic.
 
-def extract_summaries(subdocuments: List[str]) -> Dict[str, str]:
+    Parameters:
+    - pages: The text of each page, clipped to BODY_CLIP (see `page_text.iter_pages`).
+
+    Returns:
+    - Dict[str, str]: Mapping of sub-document titles to their text.
     """
-    Generate summaries for a list of subdocuments using an LLM model.
+    return dict(iter_subdocuments(pages))
+
+
+prompt1 = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are the greatest legal document summarizer in the world.\n"
+            "You summarize legal documents for the general public impacted by class actions",
+        ),
+        (
+            "human",
+            "Please summarize the following legal document from the settlement against AAC. First outline the content of the document then, if relevant report any key figures or facts. "
+            "Please focus on information specific to this document, as opposed to information that is general to the whole lawsuit"
+            "\n---\n\n{text}",
+        ),
+    ]
+)
+
+prompt2 = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are the greatest legal document summarizer in the world.\n"
+            "You are provided chunks of a given legal document (separated by three dashes ---) "
+            "and provide summaries for the general public impacted by class actions",
+        ),
+        (
+            "human",
+            "Please summarize the following text from the settlement against AAC. First outline the content of the document then, if relevant report any key figures or facts. "
+            "Please focus on information specific to this document, as opposed to information that is general to the whole lawsuit"
+            "\n---\n\n{text}",
+        ),
+    ]
+)
+
+
+def prepare_subdocuments(
+    subdocuments: Iterable[Tuple[str, str]],
+) -> Iterator[Tuple[str, Tuple[str, Union[str, List[str]]]]]:
+    """
+    Runs the language check and chunking of each sub-document, i.e. all the work
+    that happens before the embedding and LLM calls. Sub-documents are yielded as soon
+    as they are ready, so they can be summarised while the rest is still being parsed.
 
     Parameters:
-    - subdocs (List[str]): List of text chunks (sub-documents).
+    - subdocuments (Iterable[Tuple[str, str]]): (title, text) pairs, e.g. from
+      `iter_subdocuments` or `dict.items()`.
 
     Returns:
-    - Dict[str, str]: A dictionary mapping sub-document titles to their summaries.
+    - Iterator[Tuple[str, Tuple[str, Union[str, List[str]]]]]: Each title with
+      ("not_english", None), ("short", text) or ("long", chunks). A title that appears
+      twice is yielded twice, and as in `split_docs` the last one counts.
     """
-    prompt1 = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You are the greatest legal document summarizer in the world.\n"
-                "You summarize legal documents for the general public impacted by class actions",
-            ),
-            (
-                "human",
-                "Please summarize the following legal document from the settlement against AAC. First outline the content of the document then, if relevant report any key figures or facts. "
-                "Please focus on information specific to this document, as opposed to information that is general to the whole lawsuit"
-                "\n---\n\n{text}",
-            ),
-        ]
-    )
+    for title, subdoc in subdocuments:
+        if not english_recog.is_english_sampled(subdoc, threshold=0.05):
+            yield title, ("not_english", None)
+        elif len(subdoc) <= 10000:
+            yield title, ("short", subdoc)
+        else:
+            yield title, ("long", make_chunks_fast([subdoc], nlp=nlp)[0])
 
-    prompt2 = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You are the greatest legal document summarizer in the world.\n"
-                "You are provided chunks of a given legal document (separated by three dashes ---) "
-                "and provide summaries for the general public impacted by class actions",
-            ),
-            (
-                "human",
-                "Please summarize the following text from the settlement against AAC. First outline the content of the document then, if relevant report any key figures or facts. "
-                "Please focus on information specific to this document, as opposed to information that is general to the whole lawsuit"
-                "\n---\n\n{text}",
-            ),
-        ]
-    )
 
-    model1 = prompt1 | llm
-    model2 = prompt2 | llm
+def summary_prompt(kind: str, payload: Union[str, List[str]]) -> Optional[PromptValue]:
+    """
+    The prompt summarising one prepared sub-document (see `prepare_subdocuments`):
+    the whole text if short, else the chunks picked by the clustering filter.
+    Returns None for text that is not in English.
+    """
+    if kind == "not_english":
+        return None
+    if kind == "short":
+        return prompt1.invoke(payload)
+    docs = [Document(chunk, chunk_n=i) for i, chunk in enumerate(payload)]
+    summ_text = fltr.transform_documents(docs)
+    summ_text = [chunk.to_document().page_content for chunk in summ_text]
+    summ_text = "\n\n----\n".join(summ_text)
+    return prompt2.invoke(summ_text)
+
+
+def summarize_subdocuments(
+    prepared: Iterable[Tuple[str, Tuple[str, Union[str, List[str]]]]],
+) -> Dict[str, str]:
+    """
+    Generate summaries for prepared sub-documents using an LLM model.
 
+    Parameters:
+    - prepared: (title, prepared) pairs from `prepare_subdocuments`.
+
+    Returns:
+    - Dict[str, str]: A dictionary mapping sub-document titles to their summaries.
+    """
     document_summaries = {}
-    for title, subdoc in subdocuments.items():
-        if not english_recog.is_english(subdoc, threshold=0.05):
+    for title, (kind, payload) in prepared:
+        prompt = summary_prompt(kind, payload)
+        if prompt is None:
             summary = "Not English"
-        elif len(subdoc) <= 10000:
-            summary = model1.invoke(subdoc).content
         else:
-            docs = [
-                Document(chunk, chunk_n=i)
-                for i, chunk in enumerate(make_chunks(subdoc, nlp=nlp))
-            ]
-            summ_text = fltr.transform_documents(docs)
-            summ_text = [chunk.to_document().page_content for chunk in summ_text]
-            summ_text = "\n\n----\n".join(summ_text)
-            summary = model2.invoke(summ_text).content
+            summary = llm.invoke(prompt).content
 
         document_summaries[title] = summary
     return document_summaries
 
 
-dry_run = False
-nlp = spacy.load("en_core_web_sm")
-docs = pd.read_sql_table("documents", engine)
-llm = ChatOpenAI(api_key=api_key)
-embedder = OpenAIEmbeddings(model="text-embedding-3-small", api_key=api_key)
-fltr = EmbeddingsClusteringFilter(embeddings=embedder, num_clusters=8, sorted=True)
-english_recog = EnglishRecognizer()
+def extract_summaries(subdocuments: Dict[str, str]) -> Dict[str, str]:
+    """
+    Generate summaries for a list of subdocuments using an LLM model.
+
+    Parameters:
+    - subdocs (Dict[str, str]): Mapping of sub-document titles to their text.
 
-for _, row in docs.iterrows():
-    if not dry_run:
-        with engine.connect() as conn:
-            if conn.execute(
-                select(summaries_table).where(
+    Returns:
+    - Dict[str, str]: A dictionary mapping sub-document titles to their summaries.
+    """
+    return summarize_subdocuments(prepare_subdocuments(subdocuments.items()))
+
+
+def pending_documents(docs: pd.DataFrame):
+    """
+    Yields the rows of `docs` that still need summarising, copying the summaries of
+    identical documents and clearing those of changed ones along the way.
+    """
+    for _, row in docs.iterrows():
+        if not dry_run:
+            with engine.connect() as conn:
+                existing = (
                     summaries_table.c.case == row.case,
                     summaries_table.c.filename == row.filename,
                 )
-            ).all():
-                continue
+                if (row.case, row.filename) in changed:
+                    _ = conn.execute(delete(summaries_table).where(*existing))
+                    conn.commit()
+                elif conn.execute(select(summaries_table).where(*existing)).all():
+                    continue
+                if rows := duplicate_rows(
+                    conn, summaries_table, row.case, row.filename
+                ):
+                    _ = conn.execute(insert(summaries_table).values(rows))
+                    conn.commit()
+                    mark_processed("summaries", [(row.case, row.filename)])
+                    continue
+        yield row
+
+
+def load_language_models(sections=None):
+    """
+    Loads the spaCy and NLTK models used by `prepare_subdocuments` in this process,
+    and keeps the queue `stream_document` pushes sub-documents to.
+    """
+    global nlp, english_recog, section_queue
+    nlp = load_chunker()
+    english_recog = EnglishRecognizer()
+    section_queue = sections
+
+
+def init_worker(sections):
+    """
+    Initialises a process of the `produce` pool. The connection pools inherited from
+    the parent through fork are dropped without closing the parent's connections, so
+    the worker opens its own rather than sharing the sockets of the parent's threads.
+    """
+    engine.dispose(close=False)
+    cache_engine.dispose(close=False)
+    load_language_models(sections)
+
+
+def prepared_sections(case: str, filename: str):
+    """The output of `prepare_subdocuments` for a filing, read page by page."""
+    path = f"data/legal_docs/{case}/{filename}.pdf"
+    return prepare_subdocuments(iter_subdocuments(iter_pages(path, clip=BODY_CLIP)))
 
-    print(f"{row.case} {row.filename}")
-    path = f"data/legal_docs/{row.case}/{row.filename}.pdf"
+
+def prepare_document(case: str, filename: str):
+    """
+    Splits a filing into sub-documents and prepares them for summarisation.
+
+    Returns:
+    - The output of `prepare_subdocuments` as a dict, or None if the PDF cannot be read.
+    """
     try:
-        with fitz.open(path) as f:
-            subdocs = split_docs(f)
+        return dict(prepared_sections(case, filename))
     except Exception:
-        print("Failed " + "-" * 80)
-        continue
+        print(f"Failed {case} {filename} " + "-" * 80)
+        return None
 
-    summaries = extract_summaries(subdocs)
+
+def stream_document(case: str, filename: str) -> Tuple[int, bool]:
+    """
+    Prepares a filing like `prepare_document`, pushing each sub-document to
+    `section_queue` as soon as it is ready so that its summary starts while the rest of
+    the filing is parsed. This is the CPU-bound half of the pipeline and runs in the
+    process pool, where it blocks while the queue is full.
+
+    Returns:
+    - Tuple[int, bool]: The number of sub-documents pushed, and whether the whole
+      filing could be read.
+    """
+    count = 0
+    try:
+        for title, prepared in prepared_sections(case, filename):
+            section_queue.put(((case, filename), count, title, prepared))
+            count += 1
+    except Exception:
+        print(f"Failed {case} {filename} " + "-" * 80)
+        return count, False
+    return count, True
+
+
+def produce(rows, sections, cpu_workers: int, n_consumers: int):
+    """
+    Streams the sub-documents of `rows` to `sections` from a process pool (see
+    `stream_document`), followed for each document by an end marker with its number
+    of sub-documents once it is fully parsed.
+    """
+    try:
+        with ProcessPoolExecutor(
+            cpu_workers, initializer=init_worker, initargs=(sections,)
+        ) as pool:
+            in_flight = deque()
+            for row in rows:
+                key = (row.case, row.filename)
+                in_flight.append((key, pool.submit(stream_document, *key)))
+                if len(in_flight) >= 2 * cpu_workers:
+                    key, future = in_flight.popleft()
+                    sections.put((key, None, None, future.result()))
+            while in_flight:
+                key, future = in_flight.popleft()
+                sections.put((key, None, None, future.result()))
+    finally:
+        for _ in range(n_consumers):
+            sections.put(None)
+
+
+def save_summaries(case: str, filename: str, summaries: Dict[str, str]):
     values = [
         {
             "sub_document": sub_document,
             "summary": summary,
-            "filename": row.filename,
-            "case": row.case,
+            "filename": filename,
+            "case": case,
         }
         for sub_document, summary in summaries.items()
     ]
@@ -239,11 +550,208 @@ for _, row in docs.iterrows():
         with engine.connect() as conn:
             _ = conn.execute(insert(summaries_table).values(values))
             conn.commit()
+        mark_processed("summaries", [(case, filename)])
+
+
+def embed_sections(sections, ready: queue.Queue, n_consumers: int):
+    """
+    Passes the sub-documents of `sections` on to the consumers through `ready`,
+    embedding the chunks of long ones together across documents: they are held back
+    until `embed_batch_chunks` chunks are buffered, or no sub-document arrived for
+    `embed_wait` seconds, and sent in one `embed_pending` call. Other sub-documents and
+    end markers are passed on at once.
+    """
+    buffered, n_chunks = [], 0
+
+    def flush():
+        nonlocal buffered, n_chunks
+        try:
+            embedding_store.embed_pending(
+                chunk for _, _, _, (_, chunks) in buffered for chunk in chunks
+            )
+        except Exception as e:
+            # the consumers embed whatever is missing when they build the prompt
+            print(f"Failed to embed {n_chunks} chunks: {e!r}")
+        for item in buffered:
+            ready.put(item)
+        buffered, n_chunks = [], 0
+
+    try:
+        while True:
+            try:
+                item = sections.get(timeout=embed_wait if buffered else None)
+            except queue.Empty:
+                flush()
+                continue
+            if item is None:
+                break
+            if item[1] is not None and item[3][0] == "long":
+                buffered.append(item)
+                n_chunks += len(item[3][1])
+                if n_chunks >= embed_batch_chunks:
+                    flush()
+            else:
+                ready.put(item)
+        flush()
+    finally:
+        for _ in range(n_consumers):
+            ready.put(None)
+
+
+def consume(sections, documents: dict, lock: threading.Lock):
+    """
+    Summarises sub-documents one at a time as they arrive, and saves a document once
+    its end marker and the summaries of all its sub-documents are in. `documents`
+    holds the summaries of the documents in progress, shared by all consumers.
+    Documents that could not be read in full, or with a failed summary, are not saved.
+    """
+    while (item := sections.get()) is not None:
+        key, index, title, payload = item
+        if index is not None:
+            kind, prepared = payload
+            try:
+                prompt = summary_prompt(kind, prepared)
+                summary = (
+                    "Not English" if prompt is None else llm.invoke(prompt).content
+                )
+            except Exception as e:
+                print(f"Failed {key[0]} {key[1]} {title}: {e!r}")
+                summary = None
+        with lock:
+            doc = documents.setdefault(key, {"summaries": {}})
+            if index is None:
+                doc["count"], doc["complete"] = payload
+            else:
+                doc["summaries"][index] = (title, summary)
+            if len(doc["summaries"]) != doc.get("count"):
+                continue
+            del documents[key]
+
+        summaries = dict(
+            title_summary for _, title_summary in sorted(doc["summaries"].items())
+        )
+        if doc["complete"] and summaries and None not in summaries.values():
+            print(f"{key[0]} {key[1]}")
+            save_summaries(*key, summaries)
+        else:
+            print(f"Failed {key[0]} {key[1]}")
+
+
+def run_pipeline(rows, cpu_workers: int, llm_workers: int):
+    """
+    Summarises `rows` with a process pool for splitting, chunking and language checks,
+    a thread embedding the chunks of long sub-documents in batches (`embed_sections`)
+    and `llm_workers` threads for the LLM calls, joined by queues of sub-documents
+    holding at most one waiting sub-document per thread.
+    An error of the producer, e.g. a broken process pool, is raised once the consumers
+    have drained the queues.
+    """
+    sections = multiprocessing.Queue(maxsize=llm_workers)
+    ready = queue.Queue(maxsize=llm_workers)
+    documents, lock = {}, threading.Lock()
+    with ThreadPoolExecutor(2) as feeders, ThreadPoolExecutor(llm_workers) as pool:
+        producer = feeders.submit(produce, rows, sections, cpu_workers, 1)
+        embedder = feeders.submit(embed_sections, sections, ready, llm_workers)
+        for future in [
+            pool.submit(consume, ready, documents, lock) for _ in range(llm_workers)
+        ]:
+            future.result()
+        embedder.result()
+        producer.result()
+
+
+def run_batch(rows, backend=None):
+    """
+    Summarises `rows` through one batch job (see `batch_jobs`) instead of live calls:
+    documents are prepared in this process, every prompt is written to the job file,
+    and the summaries are inserted once the job completes. Documents with a failed
+    request are left out, so that the next run picks them up again.
+    """
+    load_language_models()
+    requests, values = [], []
+    for row in rows:
+        prepared = prepare_document(row.case, row.filename)
+        if prepared is None:
+            continue
+        embedding_store.embed_pending(
+            chunk
+            for kind, payload in prepared.values()
+            if kind == "long"
+            for chunk in payload
+        )
+        for title, (kind, payload) in prepared.items():
+            key = {"sub_document": title, "filename": row.filename, "case": row.case}
+            prompt = summary_prompt(kind, payload)
+            if prompt is None:
+                values.append(key | {"summary": "Not English"})
+            else:
+                requests.append(chat_request(json.dumps(key), llm, prompt))
+
+    completions = run_job("summaries", requests, backend)
+    failed = set()
+    for custom_id, completion in completions.items():
+        key = json.loads(custom_id)
+        if completion is None:
+            failed.add((key["case"], key["filename"]))
+        else:
+            values.append(key | {"summary": content(completion)})
+    values = [v for v in values if (v["case"], v["filename"]) not in failed]
+
+    if dry_run:
+        pprint(values)
+    elif values:
+        with engine.connect() as conn:
+            _ = conn.execute(insert(summaries_table).values(values))
+            conn.commit()
+        mark_processed("summaries", {(v["case"], v["filename"]) for v in values})
+
+
+if __name__ == "__main__":
+    create_tables()
+    dry_run = False
+    cpu_workers = os.cpu_count()
+    # concurrent LLM calls allowed by the API
+    llm_workers = 8
+    # chunks of long sub-documents embedded per request, across documents, and how
+    # long to wait for more before sending a smaller batch
+    embed_batch_chunks = 2048
+    embed_wait = 1.0
+    # for backfills: send every prompt in one batch job rather than live calls,
+    # through `batch_backend` (None for the OpenAI Batch API, LocalBatches() to test)
+    batch_mode = False
+    batch_backend = None
+    docs = pd.read_sql_table("documents", engine)
+    llm = chat_model()
+    embedding_model = "text-embedding-3-small"
+    embedding_store = EmbeddingStore(embeddings(model=embedding_model), embedding_model)
+    fltr = EmbeddingsClusteringFilter(
+        embeddings=StoredEmbeddings(embedding_store), num_clusters=8, sorted=True
+    )
+    changed = changed_documents("summaries", zip(docs.case, docs.filename))
+    fill(
+        [
+            f"data/legal_docs/{case}/{filename}.pdf"
+            for case, filename in zip(docs.case, docs.filename)
+        ],
+        clip=BODY_CLIP,
+    )
+
+    if batch_mode:
+        run_batch(pending_documents(docs), batch_backend)
+    else:
+        run_pipeline(
+            pending_documents(docs),
+            cpu_workers=cpu_workers,
+            llm_workers=llm_workers,
+        )
+
+    print(llm_cache.stats())
+    print(limiter_stats())
 
-# from sqlalchemy import delete
+    # from sqlalchemy import delete
 
-# with engine.connect() as conn:
-#     _ = conn.execute(delete(summaries_table))
-#     conn.commit()
+    # with engine.connect() as conn:
+    #     _ = conn.execute(delete(summaries_table))
+    #     conn.commit()
 
-pd.read_sql_table("summaries", engine)
+    pd.read_sql_table("summaries", engine)
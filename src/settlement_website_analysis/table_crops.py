@@ -0,0 +1,111 @@
+import base64
+import hashlib
+import math
+from typing import Dict, Iterable, Optional, Tuple
+
+import fitz
+from sqlalchemy import insert, select
+
+from src.settlement_website_analysis.orm import (
+    cache_engine,
+    crop_images_table,
+    table_crops_table,
+)
+
+# resolution of the crops sent to the vision model when not chosen adaptively
+default_dpi = 120
+# adaptive resolution: the smallest text of the table is rendered at least this tall,
+# in steps of `dpi_step` (so near-identical tables share cache entries) within the bounds
+min_text_px = 10
+min_dpi, max_dpi, dpi_step = 60, 200, 10
+# the `dpi` adaptive crops are cached under, so that a cached crop is found without
+# reading the page's fonts first
+adaptive = 0
+
+
+def _bbox_key(bbox: Tuple) -> str:
+    return ",".join(f"{x:.1f}" for x in bbox)
+
+
+def adaptive_dpi(page: fitz.Page, bbox: Tuple) -> int:
+    """
+    The lowest resolution at which the smallest font inside `bbox` stays legible,
+    i.e. at least `min_text_px` pixels tall. Falls back to `default_dpi` for tables
+    without a text layer.
+    """
+    sizes = [
+        span["size"]
+        for block in page.get_text("dict", clip=bbox)["blocks"]
+        for line in block.get("lines", [])
+        for span in line["spans"]
+        if span["text"].strip()
+    ]
+    if not sizes:
+        return default_dpi
+    dpi = math.ceil(min_text_px * 72 / min(sizes) / dpi_step) * dpi_step
+    return max(min_dpi, min(max_dpi, dpi))
+
+
+def crop(
+    page: fitz.Page, bbox: Tuple, sha256: str, dpi: Optional[int] = default_dpi
+) -> str:
+    """
+    Renders the `bbox` area of a page, unless that (file hash, page, bbox, dpi) crop is
+    already cached, and stores the image once per content hash. Adaptive crops are
+    cached under `dpi` = `adaptive`, as their resolution depends only on the page.
+
+    Parameters:
+    - page (fitz.Page): The page of the table.
+    - bbox (Tuple): The (x0, y0, x1, y1) area of the table.
+    - sha256 (str): The hash of the PDF, see `blobs.file_hash`.
+    - dpi (int): The rendering resolution, or None to pick it with `adaptive_dpi`.
+
+    Returns:
+    - str: The hash of the image, see `load_crops`.
+    """
+    key = {
+        "sha256": sha256,
+        "page": page.number,
+        "bbox": _bbox_key(bbox),
+        "dpi": adaptive if dpi is None else dpi,
+    }
+    with cache_engine.connect() as conn:
+        image_hash = conn.execute(
+            select(table_crops_table.c.image_hash).where(
+                *(table_crops_table.c[k] == v for k, v in key.items())
+            )
+        ).scalar()
+        if image_hash is not None:
+            return image_hash
+
+        dpi = dpi or adaptive_dpi(page, bbox)
+        image = page.get_pixmap(clip=bbox, dpi=dpi).tobytes()
+        image_hash = hashlib.sha256(image).hexdigest()
+        _ = conn.execute(
+            insert(crop_images_table)
+            .prefix_with("OR IGNORE")
+            .values(image_hash=image_hash, image=image)
+        )
+        _ = conn.execute(
+            insert(table_crops_table)
+            .prefix_with("OR IGNORE")
+            .values(image_hash=image_hash, **key)
+        )
+        conn.commit()
+    return image_hash
+
+
+def load_crops(image_hashes: Iterable[str]) -> Dict[str, str]:
+    """The base64 encoded images of the given crops, each loaded once."""
+    image_hashes = list(set(image_hashes))
+    images = {}
+    with cache_engine.connect() as conn:
+        for i in range(0, len(image_hashes), 500):
+            rows = conn.execute(
+                select(crop_images_table.c.image_hash, crop_images_table.c.image).where(
+                    crop_images_table.c.image_hash.in_(image_hashes[i : i + 500])
+                )
+            )
+            for image_hash, image in rows:
+                images[image_hash] = base64.b64encode(image).decode("utf-8")
+    return images
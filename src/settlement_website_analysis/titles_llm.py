@@ -1,11 +1,17 @@
+import re
 import pandas as pd
 import fitz
 from glob import glob
-from langchain_openai import ChatOpenAI
+from typing import List, Tuple
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.pydantic_v1 import BaseModel, Field
 from sqlalchemy import insert, select, delete
-from orm import documents_table, engine
-from assets import api_key
+from src.settlement_website_analysis.assets import data_folder
+from src.settlement_website_analysis.clients import chat_model, limiter_stats
+from src.settlement_website_analysis.blobs import duplicate_rows
+from src.settlement_website_analysis.llm_cache import llm_cache
+from src.settlement_website_analysis.orm import create_tables, documents_table, engine
+from src.settlement_website_analysis.page_text import fill, get_pages
 
 prompt = ChatPromptTemplate.from_messages(
     [
@@ -34,15 +40,155 @@ If no title is provided, return "No title provided"
     ]
 )
 
-llm = ChatOpenAI(api_key=api_key)
+
+class PageTitle(BaseModel):
+    page: int = Field(description="The number of the page, as given in its PAGE header")
+    title: str = Field(
+        description='The title of the page, or "No title provided" if it has none'
+    )
+
+
+class PageTitles(BaseModel):
+    titles: List[PageTitle] = Field(description="One title per page provided")
+
+
+batch_prompt = ChatPromptTemplate.from_messages(
+    [
+        prompt.messages[0],
+        (
+            "user",
+            """please read the following pages of legal documents, and extract the title of each one:
+            {pages}""",
+        ),
+    ]
+)
+
+exhibit_pattern = re.compile(r"^EXHIBIT [^\s]{1,3}$")
+# first words of the document types in the examples above
+title_starts = {
+    "AFFIDAVIT",
+    "AMENDED",
+    "BRIEF",
+    "CERTIFICATE",
+    "DECLARATION",
+    "FINAL",
+    "JOINT",
+    "JUDGMENT",
+    "LEAD",
+    "MEMORANDUM",
+    "MOTION",
+    "NOTICE",
+    "ORDER",
+    "PLAINTIFF’S",
+    "PLAINTIFFS’",
+    "PROOF",
+    "[PROPOSED]",
+    "REPLY",
+    "STATEMENT",
+    "STIPULATION",
+    "SUMMARY",
+    "SUPPLEMENTAL",
+}
+title_words = re.compile(
+    r"\b(NOTICE|MOTION|DECLARATION|ORDER|STIPULATION|MEMORANDUM|JUDGMENT|PROOF OF CLAIM|"
+    r"CLAIM FORM|AFFIDAVIT|BRIEF|STATEMENT|AGREEMENT|SETTLEMENT|REPORT)\b"
+)
+# court captions are also in capitals
+caption_words = re.compile(
+    r"\b(COURT$|DISTRICT OF|IN RE\b|LITIGATION,?$|CASE NO|CIVIL ACTION NO|HON\.|"
+    r"JUDGE:|PLAINTIFFS?,|DEFENDANTS?\.|VS?\.)|^(CLASS ACTION|ALL ACTIONS\.?)$",
+)
+# pages whose heuristic title scores lower go to the LLM
+min_confidence = 0.7
+# longer blocks of capitals are rather merged headings or body text, and score lower
+max_title_words = 30
+batch_pages = 8
+
+
+def _is_caps(line: str) -> bool:
+    letters = [c for c in line if c.isalpha()]
+    return len(letters) >= 2 and sum(c.isupper() for c in letters) >= 0.9 * len(letters)
+
+
+def heuristic_title(page: str) -> Tuple[str, float]:
+    """
+    Reads the title of a page without the LLM: an `EXHIBIT X` cover page, or the block of
+    consecutive capitalised lines that looks most like a document title.
+
+    Parameters:
+    - page (str): The text of the first page.
+
+    Returns:
+    - Tuple[str, float]: The title and a confidence between 0 and 1.
+    """
+    lines = [" ".join(line.split()) for line in page.splitlines()]
+    lines = [line for line in lines if line]
+    if not lines:
+        return "No title provided", 1.0
+    if exhibit_pattern.match(" ".join(lines)):
+        return " ".join(lines), 1.0
+    if len(lines) <= 3 and exhibit_pattern.match(lines[0]):
+        return lines[0], 0.9
+
+    # caption lines end a block, and a document type word starts a new one
+    blocks, block = [], []
+    for line in lines + [""]:
+        starts_title = line.split(" ")[0] in title_starts
+        if block and (not _is_caps(line) or caption_words.search(line) or starts_title):
+            blocks.append(" ".join(block))
+            block = []
+        if line and _is_caps(line) and not caption_words.search(line):
+            block.append(line)
+
+    scored = []
+    for text in blocks:
+        score = 0.3 * bool(title_words.search(text)) + 0.1 * (len(text.split()) >= 3)
+        score += 0.6 * (text.split()[0] in title_starts)
+        score -= 0.7 * bool(caption_words.search(text))
+        score -= 0.5 * (len(text.split()) > max_title_words)
+        scored.append((score, text))
+    if not scored:
+        return "No title provided", 0.0
+    scored.sort(key=lambda x: -x[0])
+    best, title = scored[0]
+    runner_up = scored[1][0] if len(scored) > 1 else 0.0
+    return title, max(0.0, min(1.0, best - 0.5 * max(runner_up, 0.0)))
+
+
+def llm_titles(pages: List[str]) -> List[str]:
+    """Extracts the titles of several pages with a single structured-output call."""
+    text = "".join(f"\n\nPAGE {i}\n{page}" for i, page in enumerate(pages, start=1))
+    out = batch_chain.invoke({"pages": text})
+    titles = {t.page: t.title for t in out.titles}
+    return [titles.get(i, "No title provided") for i in range(1, len(pages) + 1)]
+
+
+def save_title(conn, filename: str, case: str, title: str):
+    stmt = insert(documents_table).values(filename=filename, title=title, case=case)
+    print(filename, case)
+    print(title)
+    result = conn.execute(stmt)
+    conn.commit()
+
+
+create_tables()
+llm = chat_model()
 files = list(
-    filter(lambda x: x.endswith(".pdf"), glob("../../data/**", recursive=True))
+    filter(
+        lambda x: x.endswith(".pdf"),
+        glob(data_folder + "legal_docs/**", recursive=True),
+    )
 )
 
-chain = prompt | llm
+batch_chain = batch_prompt | llm.with_structured_output(
+    schema=PageTitles, include_raw=False
+)
+fill(files)
 
 # TODO skip files if empty
 
+# pages whose title is not clear enough from `heuristic_title`
+pending = []
 for f in files:
     with engine.connect() as conn:
         path = f.replace("\\", "/").split("/")
@@ -57,18 +203,39 @@ for f in files:
         if res.all():
             continue
 
+        if rows := duplicate_rows(conn, documents_table, case, filename):
+            title = rows[0]["title"]
+            print(filename, case, "(duplicate)")
+            conn.execute(
+                insert(documents_table).values(
+                    filename=filename, title=title, case=case
+                )
+            )
+            conn.commit()
+            continue
+
         try:
-            p1 = fitz.open(f)[0].get_text()
-            title = chain.invoke({"page", p1}).content
-        except fitz.FileDataError as e:
-            title = "No title provided"
+            p1 = get_pages(f)[0]
+        except (fitz.FileDataError, IndexError) as e:
+            save_title(conn, filename, case, "No title provided")
+            continue
 
-        stmt = insert(documents_table).values(filename=filename, title=title, case=case)
-        print(filename, case)
-        print(title)
-        result = conn.execute(stmt)
-        conn.commit()
+        title, confidence = heuristic_title(p1)
+        if confidence >= min_confidence:
+            save_title(conn, filename, case, title)
+        else:
+            pending.append((filename, case, p1))
+
+print(f"{len(pending)} titles left to the LLM")
+for i in range(0, len(pending), batch_pages):
+    batch = pending[i : i + batch_pages]
+    titles = llm_titles([p1 for _, _, p1 in batch])
+    with engine.connect() as conn:
+        for (filename, case, _), title in zip(batch, titles):
+            save_title(conn, filename, case, title)
 
+print(llm_cache.stats())
+print(limiter_stats())
 
 with engine.connect() as conn:
     t = pd.read_sql_table("documents", conn)
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from typing import List
+
+import faiss
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from src.settlement_website_analysis.assets import data_folder
+
+index_folder = data_folder + "vector_indexes/"
+
+
+def index_key(sha256: str, *params) -> str:
+    """
+    Names the index of a document: its content hash plus whatever changes the vectors,
+    e.g. the embedding model and the chunking parameters.
+    """
+    return hashlib.sha256("|".join(map(str, (sha256, *params))).encode()).hexdigest()
+
+
+def index_exists(key: str) -> bool:
+    return os.path.exists(f"{index_folder}{key}")
+
+
+def load_index(key: str, embedding: Embeddings) -> FAISS:
+    """
+    Loads a saved index, or returns None if no index was saved under `key`.
+    """
+    folder = f"{index_folder}{key}/"
+    if not index_exists(key):
+        return None
+    index = faiss.read_index(folder + "index.faiss")
+    with open(folder + "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embedding, index, docstore, index_to_docstore_id)
+
+
+def build_index(key: str, chunks: List[str], embedding: Embeddings) -> FAISS:
+    """
+    Embeds a document's chunks into a FAISS index and saves it under `key`.
+
+    Parameters:
+    - key (str): The index name, see `index_key`.
+    - chunks (List[str]): The chunks of text to index.
+    - embedding (Embeddings): The model used to embed the chunks and the queries.
+
+    Returns:
+    - FAISS: The vector store.
+    """
+    vectorstore = FAISS.from_texts(chunks, embedding=embedding)
+    os.makedirs(index_folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(dir=index_folder, suffix=".part")
+    vectorstore.save_local(tmp_folder)
+    try:
+        os.rename(tmp_folder, f"{index_folder}{key}")
+    except OSError:
+        # saved concurrently by another process
+        shutil.rmtree(tmp_folder)
+    return vectorstore
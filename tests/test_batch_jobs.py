@@ -0,0 +1,191 @@
+"""
+Batch mode end to end on `LocalBatches`: the summaries and notice rows saved from a job
+must be those of the request each custom_id was sent with.
+
+Run from the repository root, as the modules resolve data/ relative to it:
+    python -m pytest tests
+"""
+
+import json
+import os
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+from sqlalchemy import create_engine
+
+# the clients are created on import and only need a key, no call is sent
+os.environ.setdefault("openai_api", "test")
+
+from src.settlement_website_analysis import (  # noqa: E402
+    batch_jobs,
+    blobs,
+    notice_extraction,
+    summary_extractions,
+)
+from src.settlement_website_analysis.batch_jobs import (  # noqa: E402
+    LocalBatches,
+    run_job,
+)
+from src.settlement_website_analysis.orm import metadata_obj  # noqa: E402
+
+llm = SimpleNamespace(model_name="gpt-test", temperature=0)
+
+
+def completion(message: dict) -> dict:
+    return {"choices": [{"index": 0, "message": {"role": "assistant"} | message}]}
+
+
+def tool_call(arguments: dict) -> dict:
+    return completion(
+        {
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": "call_0",
+                    "type": "function",
+                    "function": {"name": "tool", "arguments": json.dumps(arguments)},
+                }
+            ],
+        }
+    )
+
+
+def prompt_text(body: dict) -> str:
+    return body["messages"][-1]["content"]
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/data.db")
+    metadata_obj.create_all(engine)
+    for module in (blobs, notice_extraction, summary_extractions):
+        monkeypatch.setattr(module, "engine", engine)
+    monkeypatch.setattr(batch_jobs, "batch_folder", f"{tmp_path}/batches/")
+    return engine
+
+
+def test_run_job_maps_completions_to_custom_ids(engine):
+    requests = [
+        {"custom_id": custom_id, "body": {"n": n}}
+        for n, custom_id in enumerate(["a", "b", "c"])
+    ]
+
+    def respond(body):
+        if body["n"] == 1:
+            raise ValueError("server error")
+        return completion({"content": str(body["n"])})
+
+    completions = run_job("test", requests, LocalBatches(respond))
+
+    assert {k: batch_jobs.content(v) for k, v in completions.items()} == {
+        "a": "0",
+        "b": None,
+        "c": "2",
+    }
+
+
+def test_summaries_round_trip(engine, monkeypatch):
+    def prepare_document(case, filename):
+        return {
+            "main": ("short", f"text of {case} {filename}"),
+            "EXHIBIT A": ("not_english", None),
+        }
+
+    monkeypatch.setattr(summary_extractions, "load_language_models", lambda: None)
+    monkeypatch.setattr(summary_extractions, "prepare_document", prepare_document)
+    monkeypatch.setattr(summary_extractions, "llm", llm, raising=False)
+    monkeypatch.setattr(summary_extractions, "dry_run", False, raising=False)
+    monkeypatch.setattr(
+        summary_extractions,
+        "embedding_store",
+        SimpleNamespace(embed_pending=lambda chunks: list(chunks)),
+        raising=False,
+    )
+
+    def respond(body):
+        text = prompt_text(body)
+        if "C2" in text:
+            raise ValueError("server error")
+        return completion({"content": "summary of " + text.rsplit("\n", 1)[-1]})
+
+    rows = [SimpleNamespace(case=f"C{i}", filename=f"F{i}") for i in range(4)]
+    summary_extractions.run_batch(rows, LocalBatches(respond))
+
+    saved = pd.read_sql_table("summaries", engine)
+    # a document with a failed request is left out entirely, for the next run
+    assert set(saved.case) == {"C0", "C1", "C3"}
+    for row in saved.itertuples():
+        i = row.case[1:]
+        if row.sub_document == "main":
+            assert row.filename == f"F{i}"
+            assert row.summary == f"summary of text of C{i} F{i}"
+        else:
+            assert row.summary == "Not English"
+
+
+def test_notices_round_trip(engine, monkeypatch):
+    def get_retriever(doc):
+        return RunnableLambda(
+            lambda query: [Document(f"notice of {doc.case} {doc.filename}")]
+        )
+
+    monkeypatch.setattr(notice_extraction, "get_retriever", get_retriever)
+    monkeypatch.setattr(
+        notice_extraction,
+        "join_output",
+        lambda docs: "\n".join(doc.page_content for doc in docs),
+    )
+    monkeypatch.setattr(notice_extraction, "llm", llm)
+
+    def respond(body):
+        # the combined call only finds the legal team, the other fields come from
+        # the per-field calls of the second job
+        text = prompt_text(body).rsplit("\n", 1)[-1]
+        name = body["tool_choice"]["function"]["name"]
+        number = float(text.split()[-1][1:])
+        if name == "NoticeInfo":
+            return tool_call({"legal_team": text})
+        if name == "ADPS":
+            return tool_call({"adps": number})
+        return tool_call({"attorney_fees": 10 * number})
+
+    docs = [SimpleNamespace(case=f"C{i}", filename=f"F{i}") for i in range(3)]
+    notice_extraction.extract_batch(docs, LocalBatches(respond))
+
+    saved = pd.read_sql_table("notice_info", engine).set_index("case")
+    assert sorted(saved.index) == ["C0", "C1", "C2"]
+    for i in range(3):
+        assert saved.loc[f"C{i}", "legal_team"] == f"notice of C{i} F{i}"
+        assert saved.loc[f"C{i}", "adps"] == i
+        assert saved.loc[f"C{i}", "attorney_fees"] == 10 * i
+
+
+def test_run_job_rejects_duplicate_custom_ids(engine):
+    requests = [{"custom_id": "a", "body": {}}] * 2
+    with pytest.raises(ValueError):
+        run_job("test", requests, LocalBatches(lambda body: {}))
+
+
+def test_notices_send_duplicate_documents_once(engine, monkeypatch):
+    monkeypatch.setattr(
+        notice_extraction,
+        "get_retriever",
+        lambda doc: RunnableLambda(lambda query: [Document("text")]),
+    )
+    monkeypatch.setattr(notice_extraction, "join_output", lambda docs: "text")
+    monkeypatch.setattr(notice_extraction, "llm", llm)
+
+    sent = []
+
+    def respond(body):
+        sent.append(body)
+        return tool_call({"legal_team": "A", "adps": 1, "attorney_fees": 2})
+
+    docs = [SimpleNamespace(case="C0", filename="F0")] * 2
+    notice_extraction.extract_batch(docs, LocalBatches(respond))
+
+    assert len(sent) == 1
+    assert len(pd.read_sql_table("notice_info", engine)) == 1
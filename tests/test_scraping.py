@@ -0,0 +1,121 @@
+"""
+Crawling a Gilardi site served by a local `http.server`: conditional requests must reuse
+the unchanged documents, and a failed download must be recorded without stopping the
+others.
+"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sqlalchemy import create_engine
+
+from src.settlement_website_analysis import blobs
+from src.settlement_website_analysis.assets import Website
+from src.settlement_website_analysis.orm import metadata_obj
+from src.settlement_website_analysis.scraping import gilardi
+
+docs_page = """<html><body><table class="table_legalRights">
+<tr><td><a href="notice.pdf">Notice</a></td></tr>
+<tr><td><a href="missing.pdf">Missing</a></td></tr>
+<tr><td><a href="truncated.pdf">Truncated</a></td></tr>
+</table></body></html>"""
+pdf = b"%PDF-1.4 notice"
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path == "/case-documents.aspx":
+            self.respond(docs_page.encode(), '"page"')
+        elif self.path == "/notice.pdf":
+            self.respond(pdf, '"notice"')
+        elif self.path == "/truncated.pdf":
+            # the connection drops halfway through the body
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b"%PDF")
+            self.close_connection = True
+        else:
+            self.send_error(404)
+
+    def respond(self, body, etag):
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Handler.requests = []
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # the crawler writes to data/legal_docs/ relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/legal_docs")
+    engine = create_engine(f"sqlite:///{tmp_path}/data.db")
+    metadata_obj.create_all(engine)
+    monkeypatch.setattr(blobs, "engine", engine)
+    return tmp_path
+
+
+def crawl(url, recrawl=False):
+    site = Website(url, "Case")
+    site.home_page = "<html></html>"
+    return gilardi(site, recrawl)
+
+
+def test_failed_downloads_are_recorded(server, data_dir):
+    changed = crawl(server)
+
+    assert changed == ["1"]
+    folder = "data/legal_docs/Case"
+    with open(f"{folder}/1.pdf", "rb") as f:
+        assert f.read() == pdf
+    with open(f"{folder}/failed.txt") as f:
+        failed = f.read().splitlines()
+    assert failed[0] == f"404,{server}missing.pdf"
+    assert failed[1].endswith(f",{server}truncated.pdf")
+    # no partial file is left behind
+    assert sorted(os.listdir(folder)) == [
+        "1.pdf",
+        "docs_page.html",
+        "failed.txt",
+        "home_page.html",
+        "index.csv",
+        "manifest.csv",
+    ]
+
+
+def test_recrawl_reuses_unchanged_documents(server, data_dir):
+    crawl(server)
+    Handler.requests = []
+
+    changed = crawl(server, recrawl=True)
+
+    assert changed == []
+    sent = dict(Handler.requests)
+    assert sent["/case-documents.aspx"] == '"page"'
+    assert sent["/notice.pdf"] == '"notice"'
+    with open("data/legal_docs/Case/1.pdf", "rb") as f:
+        assert f.read() == pdf